@@ -0,0 +1,184 @@
+import time
+import random
+import pickle
+import argparse
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from preprocess import window_lengths, NegativeSampler, PopTable, UserHistories, generate_negative_samples_vectorized_parallel
+
+parser = argparse.ArgumentParser()
+parser.add_argument("bench", type=str, choices=['ranges', 'negatives', 'pool'],
+                    help="benchmark to run")
+parser.add_argument("--num_users", type=int, default=200000,
+                    help="number of synthetic users")
+parser.add_argument("--num_events", type=int, default=5000000,
+                    help="number of synthetic interactions")
+parser.add_argument("--legacy_users", type=int, default=1000,
+                    help="number of users to run through the per-row reference implementation")
+parser.add_argument("--num_items", type=int, default=200000,
+                    help="number of synthetic catalog items")
+parser.add_argument("--num_rows", type=int, default=20000,
+                    help="number of positive rows to draw negatives for")
+parser.add_argument("--legacy_rows", type=int, default=200,
+                    help="number of rows to run through the set difference and shuffle reference")
+parser.add_argument("--num_samples", type=int, default=4,
+                    help="negatives per positive row")
+parser.add_argument("--workers", type=str, default='1,8',
+                    help="comma separated pool sizes for the pool benchmark")
+parser.add_argument("--k_m", type=int, default=6,
+                    help="mid-term window in months")
+parser.add_argument("--k_s", type=int, default=1,
+                    help="short-term window in months")
+
+args = parser.parse_args()
+
+def make_reviews(num_users, num_events):
+    rng = np.random.default_rng(2024)
+    # long-tailed activity: most users have a handful of interactions
+    activity = rng.pareto(1.5, num_users) + 1
+    users = rng.choice(num_users, num_events, p=activity / activity.sum())
+    seconds = rng.integers(0, 10 * 365 * 24 * 3600, num_events)
+    # some interactions land on month ends and share a timestamp with another one
+    timestamps = pd.Timestamp('2010-01-31') + pd.to_timedelta(seconds, unit='s')
+    month_ends = rng.random(num_events) < 0.05
+    timestamps = timestamps.where(~month_ends, timestamps.normalize() + pd.offsets.MonthEnd(0))
+    df = pd.DataFrame({'user_encoded': users, 'timestamp': timestamps})
+    return df.sort_values(by=['user_encoded', 'timestamp']).reset_index(drop=True)
+
+def legacy_calculate_ranges(group, k_m, k_s):
+    # per-row slicing as preprocess.calculate_ranges did before window_lengths
+    k_m_delta = relativedelta(months=k_m)
+    k_s_delta = relativedelta(months=k_s)
+    group.set_index('timestamp', inplace=True)
+
+    def get_mid_len(x):
+        start_time = max(group.index.min(), x - k_m_delta)
+        return group.loc[start_time:x].shape[0] - 1
+
+    def get_short_len(x):
+        start_time = max(group.index.min(), x - k_s_delta)
+        return group.loc[start_time:x].shape[0] - 1
+
+    group['mid_len'] = group.index.to_series().apply(get_mid_len)
+    group['short_len'] = group.index.to_series().apply(get_short_len)
+    group.reset_index(inplace=True)
+
+    return group[['mid_len', 'short_len']]
+
+def bench_ranges():
+    df = make_reviews(args.num_users, args.num_events)
+    print(f"{len(df)} interactions, {df['user_encoded'].nunique()} users, longest history {df['user_encoded'].value_counts().max()}")
+
+    start = time.perf_counter()
+    mid_len = window_lengths(df, args.k_m)
+    short_len = window_lengths(df, args.k_s)
+    vectorized_sec = time.perf_counter() - start
+    print(f"window_lengths: {vectorized_sec:.2f}s")
+
+    # the reference is run on a sample of users and scaled by their share of the rows
+    rng = np.random.default_rng(0)
+    sample_users = rng.choice(df['user_encoded'].unique(), min(args.legacy_users, df['user_encoded'].nunique()), replace=False)
+    mask = df['user_encoded'].isin(sample_users).to_numpy()
+    legacy_df = df[mask]
+    start = time.perf_counter()
+    ranges_df = legacy_df.groupby('user_encoded', group_keys=False).apply(
+        lambda x: legacy_calculate_ranges(x, args.k_m, args.k_s), include_groups=False)
+    legacy_sec = time.perf_counter() - start
+    legacy_sec_scaled = legacy_sec * len(df) / len(legacy_df)
+    print(f"calculate_ranges: {len(sample_users)} users, {len(legacy_df)} interactions in {legacy_sec:.2f}s "
+          f"(~{legacy_sec_scaled:.0f}s for all interactions)")
+
+    assert np.array_equal(ranges_df['mid_len'].to_numpy(), mid_len[mask])
+    assert np.array_equal(ranges_df['short_len'].to_numpy(), short_len[mask])
+    print(f"identical on the sample, speedup: {legacy_sec_scaled / vectorized_sec:.0f}x")
+
+def legacy_sample(all_item_ids, item_encoded, item_his_encoded_set, num_samples, valid, unit_time):
+    # candidate selection as generate_negative_samples_for_row did before NegativeSampler
+    candidate_items = list(all_item_ids - item_his_encoded_set - {item_encoded})
+    random.shuffle(candidate_items)
+    neg_samples = []
+    for item in candidate_items:
+        if valid[item, unit_time]:
+            neg_samples.append(item)
+            if len(neg_samples) == num_samples:
+                break
+    return neg_samples
+
+def bench_negatives():
+    rng = np.random.default_rng(2024)
+    max_time = 40
+    # items score from their release on, like the popularity output
+    release_times = rng.integers(0, max_time + 1, args.num_items + 1)
+    valid = np.arange(max_time + 1)[None, :] >= release_times[:, None]
+    valid[0] = False
+    sampler = NegativeSampler(SimpleNamespace(valid=valid.T), args.num_items)
+    rows = [(int(rng.integers(1, args.num_items + 1)), rng.integers(1, args.num_items + 1, int(rng.integers(1, 128))),
+             int(rng.integers(0, max_time + 1))) for _ in range(args.num_rows)]
+
+    start = time.perf_counter()
+    samples = [sampler.sample(rng, item, history, unit_time, args.num_samples) for item, history, unit_time in rows]
+    sampler_sec = time.perf_counter() - start
+    print(f"NegativeSampler: {args.num_rows} rows x {args.num_samples} negatives over {args.num_items} items in {sampler_sec:.2f}s")
+
+    all_item_ids = set(range(1, args.num_items + 1))
+    start = time.perf_counter()
+    for item, history, unit_time in rows[:args.legacy_rows]:
+        legacy_sample(all_item_ids, item, set(history.tolist()), args.num_samples, valid, unit_time)
+    legacy_sec = time.perf_counter() - start
+    legacy_sec_scaled = legacy_sec * args.num_rows / args.legacy_rows
+    print(f"set difference + shuffle: {args.legacy_rows} rows in {legacy_sec:.2f}s (~{legacy_sec_scaled:.0f}s for all rows)")
+
+    for (item, history, unit_time), sample in zip(rows[:2000], samples):
+        assert len(sample) == min(args.num_samples, np.setdiff1d(sampler.pool(unit_time), np.append(history, item)).size)
+        assert len(np.unique(sample)) == len(sample) and not np.isin(sample, np.append(history, item)).any()
+        assert valid[sample, unit_time].all()
+    print(f"all samples distinct, valid and outside the history, speedup: {legacy_sec_scaled / sampler_sec:.0f}x")
+
+def bench_pool():
+    rng = np.random.default_rng(2024)
+    max_time = 40
+    release_times = rng.integers(0, max_time + 1, args.num_items + 1)
+    valid = np.arange(max_time + 1)[None, :] >= release_times[:, None]
+    valid[0] = False
+    pop_table = PopTable(rng.random((max_time + 1, args.num_items + 1, 2), dtype=np.float32), valid.T)
+    sampler = NegativeSampler(pop_table, args.num_items)
+
+    reviews = make_reviews(args.num_users, args.num_rows)
+    df = pd.DataFrame({
+        'user_encoded': reviews['user_encoded'],
+        'item_encoded': rng.integers(1, args.num_items + 1, len(reviews)),
+        'cat_encoded': rng.integers(1, 100, len(reviews)),
+        'timestamp': reviews['timestamp'],
+        'unit_time': rng.integers(0, max_time + 1, len(reviews))
+    })
+    df['conformity'], df['quality'], _ = pop_table.lookup(df['item_encoded'], df['unit_time'])
+    histories, df['his_offset'], df['his_pos'] = UserHistories.from_frame(df)
+    df['mid_len'] = window_lengths(df, args.k_m)
+    df['short_len'] = window_lengths(df, args.k_s)
+    item_to_cat = dict(zip(df['item_encoded'], df['cat_encoded']))
+
+    # what one starmap task used to pickle: a DataFrame chunk plus every shared structure
+    num_chunks = 16
+    chunk = df.iloc[:-(-len(df) // num_chunks)]
+    legacy_task = (chunk, sampler, histories, args.num_samples, item_to_cat, np.random.SeedSequence(2024))
+    print(f"{len(df)} rows, starmap task with a DataFrame chunk and shared structures: {len(pickle.dumps(legacy_task)) / 1024 ** 2:.1f}MB serialized")
+
+    results = []
+    for num_workers in [int(workers) for workers in args.workers.split(',')]:
+        start = time.perf_counter()
+        results.append(generate_negative_samples_vectorized_parallel(df, sampler, histories, args.num_samples, item_to_cat, num_workers))
+        print(f"num_workers={num_workers}: {time.perf_counter() - start:.2f}s")
+    assert all(result.equals(results[0]) for result in results)
+    print("identical negatives for every pool size")
+
+if __name__ == "__main__":
+    if args.bench == 'ranges':
+        bench_ranges()
+    elif args.bench == 'negatives':
+        bench_negatives()
+    elif args.bench == 'pool':
+        bench_pool()
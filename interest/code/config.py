@@ -31,6 +31,11 @@ class Config(object):
 
         self.model_path = f'../../model/'
 
+        self.halving_factor = args.halving_factor
+        self.halving_min_epochs = args.halving_min_epochs
+        self.preprocess_workers = args.preprocess_workers
+        self.online_negatives = args.online_negatives
+
         self.cuda_device = args.cuda_device
         
         
\ No newline at end of file
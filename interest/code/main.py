@@ -15,9 +15,9 @@ from torch.optim import Adam
 from torch.optim.lr_scheduler import StepLR
 
 from config import Config
-from preprocess import load_file, preprocess_df, create_dataloader
+from preprocess import load_file, load_pop_columns, preprocess_df, create_dataloader, PopTable, UserHistories, NegativeSampler, HANDOFF_FILE
 from Model import CAMP
-from training_utils import train, evaluate, test, EarlyStopping
+from training_utils import train, evaluate, test, EarlyStopping, SuccessiveHalving
 
 random.seed(2024) 
 torch.manual_seed(2024)
@@ -64,6 +64,16 @@ parser.add_argument('--wo_con', action="store_true",
 parser.add_argument('--wo_qlt', action="store_true", 
                     help='flag to indicate if model has quality module')
 
+parser.add_argument("--halving_factor", type=int, default=3,
+                    help="successive halving keeps the best 1/halving_factor of grid trials at each milestone (0: no pruning); "
+                         "the skew, reg and seq grids hold a single configuration, so only the fallback grid is pruned")
+parser.add_argument("--halving_min_epochs", type=int, default=2,
+                    help="first successive halving milestone, later ones grow by halving_factor")
+parser.add_argument("--online_negatives", action="store_true",
+                    help="store only train positives and draw fresh train negatives every epoch")
+parser.add_argument("--preprocess_workers", type=int, default=8,
+                    help="processes drawing negative samples during preprocessing (1: in-process)")
+
 parser.add_argument('--cuda_device', type=str, help='CUDA device to use')
 
 parser.add_argument('--discrepancy_loss_weight', type=float, default=0.01, 
@@ -90,16 +100,27 @@ def setup_logging(dataset_name, data_type, option):
                         format='%(asctime)s:%(levelname)s:%(message)s',
                         datefmt='%Y-%m-%d')
 
+def load_pop_table(dataset_path, dataset_name):
+    pop_file_path = f'{dataset_path}pop_{dataset_name}/'
+    if os.path.exists(os.path.join(pop_file_path, HANDOFF_FILE)):
+        return PopTable.open(os.path.join(pop_file_path, HANDOFF_FILE))
+    elif os.path.isdir(pop_file_path):
+        return PopTable.from_frame(load_pop_columns(pop_file_path))
+    return PopTable.from_frame(load_file(f'{dataset_path}pop_{dataset_name}.pkl'))
+
 def load_df(dataset_name):    
     dataset_path = f'../../dataset/{dataset_name}/'
     review_file_path = f'{dataset_path}{dataset_name}.pkl'
-    pop_file_path = f'{dataset_path}pop_{dataset_name}.pkl'
     processed_path = f'{dataset_path}preprocessed/'
+    # train splits without negatives are kept apart from ones that have them
+    train_name = 'train_pos_df' if config.online_negatives else 'train_df'
+    pop_table = None
 
-    if os.path.exists(f'{processed_path}/train_df_{config.data_type}.pkl') and os.path.exists(f'{processed_path}/valid_df_{config.data_type}.pkl') and os.path.exists(f'{processed_path}/test_df_{config.data_type}.pkl') and config.df_preprocessed:
-        train_df = load_file(f'{processed_path}/train_df_{config.data_type}.pkl')
+    if os.path.exists(f'{processed_path}/{train_name}_{config.data_type}.pkl') and os.path.exists(f'{processed_path}/valid_df_{config.data_type}.pkl') and os.path.exists(f'{processed_path}/test_df_{config.data_type}.pkl') and os.path.exists(f'{processed_path}/histories_{config.data_type}.npz') and config.df_preprocessed:
+        train_df = load_file(f'{processed_path}/{train_name}_{config.data_type}.pkl')
         valid_df = load_file(f'{processed_path}/valid_df_{config.data_type}.pkl')
         test_df = load_file(f'{processed_path}/test_df_{config.data_type}.pkl')
+        histories = UserHistories.load(f'{processed_path}/histories_{config.data_type}.npz')
         
         combined_df = pd.concat([train_df, valid_df, test_df])
         num_users = combined_df['user_encoded'].max() + 1
@@ -112,24 +133,31 @@ def load_df(dataset_name):
     else:
         try:
             df = load_file(review_file_path)
-            df_pop = load_file(pop_file_path)
+            pop_table = load_pop_table(dataset_path, dataset_name)
 
             num_users = df['user_encoded'].max() + 1
             num_items = df['item_encoded'].max() + 1
             num_cats = df['cat_encoded'].max() + 1            
 
-            train_df, valid_df, test_df = preprocess_df(df, df_pop, config)
+            train_df, valid_df, test_df, histories = preprocess_df(df, pop_table, config)
             if not os.path.exists(processed_path):
                 os.makedirs(processed_path)
             date_str = datetime.now().strftime('%Y%m%d')
-            train_df.to_pickle(f'{processed_path}/train_df_{config.data_type}_{date_str}.pkl')
+            train_df.to_pickle(f'{processed_path}/{train_name}_{config.data_type}_{date_str}.pkl')
             valid_df.to_pickle(f'{processed_path}/valid_df_{config.data_type}_{date_str}.pkl')
             test_df.to_pickle(f'{processed_path}/test_df_{config.data_type}_{date_str}.pkl')
+            histories.save(f'{processed_path}/histories_{config.data_type}_{date_str}.npz')
         except Exception as e:
             logging.error(f"Error during data preparation: {str(e)}")
             raise
     
-    return train_df, valid_df, test_df, num_users, num_items, num_cats
+    sampler, item_to_cat = None, None
+    if config.online_negatives:
+        positives_df = pd.concat([train_df, valid_df[valid_df['label'] == 1], test_df[test_df['label'] == 1]])
+        item_to_cat = positives_df.set_index('item_encoded')['cat_encoded'].to_dict()
+        sampler = NegativeSampler(pop_table if pop_table is not None else load_pop_table(dataset_path, dataset_name), positives_df['item_encoded'].max())
+    
+    return train_df, valid_df, test_df, histories, num_users, num_items, num_cats, sampler, item_to_cat
 
 def main():
     option = ''
@@ -157,10 +185,11 @@ def main():
     setup_logging(config.dataset, config.data_type, option)
         
     print(f"Data preprocessing for dataset {config.dataset}......")
-    train_df, valid_df, test_df, num_users, num_items, num_cats = load_df(config.dataset)
+    train_df, valid_df, test_df, histories, num_users, num_items, num_cats, sampler, item_to_cat = load_df(config.dataset)
 
     print("Create datasets......")
-    train_loader, valid_loader, test_loader = create_dataloader(train_df, valid_df, test_df)
+    train_loader, valid_loader, test_loader = create_dataloader(train_df, valid_df, test_df, histories, sampler=sampler, item_to_cat=item_to_cat,
+                                                                num_samples=config.train_num_samples)
 
     del train_df, valid_df, test_df
     torch.cuda.empty_cache()
@@ -187,6 +216,8 @@ def main():
     best_loss = float('inf')
     best_model_params = {}
     best_model = None
+    halving = SuccessiveHalving(config.num_epochs, config.halving_factor, config.halving_min_epochs)
+    num_trials, num_pruned, epochs_saved = 0, 0, 0
 
     if not config.test_only:
         for lr, batch_size, embedding_dim in itertools.product(learning_rates, batch_sizes, embedding_dims):            
@@ -203,6 +234,8 @@ def main():
             early_stopping = EarlyStopping(patience=10, verbose=True)
 
             for epoch in range(config.num_epochs):
+                if config.online_negatives:
+                    train_loader.dataset.resample(epoch)
                 train_loss = train(model, train_loader, optimizer, device)                            
                 valid_loss = evaluate(model, valid_loader, device)
                 scheduler.step()
@@ -217,6 +250,13 @@ def main():
                 if early_stopping.early_stop:
                     print("Early stopping triggered")
                     break
+                if halving(epoch + 1, valid_loss):
+                    num_pruned += 1
+                    epochs_saved += config.num_epochs - (epoch + 1)
+                    print(f"Pruned by successive halving after epoch {epoch+1}")
+                    logging.info(f"Pruned by successive halving after epoch {epoch+1}")
+                    break
+            num_trials += 1
             
 
             # if config.dataset == "14_Sports":
@@ -239,6 +279,9 @@ def main():
             del model, optimizer, scheduler, early_stopping
             torch.cuda.empty_cache()
 
+        print(f"Successive halving pruned {num_pruned} of {num_trials} trials, saving up to {epochs_saved} of {config.num_epochs * num_trials} epochs")
+        logging.info(f"Successive halving pruned {num_pruned} of {num_trials} trials, saving up to {epochs_saved} of {config.num_epochs * num_trials} epochs")
+
         if best_model is not None:
             print(f"Best Model Parameters: {best_model_params}")
             logging.info(f"Best Model Parameters: {best_model_params}")
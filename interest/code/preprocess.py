@@ -1,7 +1,7 @@
-import random
+import os
+import json
 import pandas as pd
 import numpy as np
-from dateutil.relativedelta import relativedelta
 import pickle
 import gc  
 import torch
@@ -9,8 +9,7 @@ from torch.utils.data import Dataset, DataLoader
 from tqdm.auto import tqdm
 from sklearn.model_selection import train_test_split
 
-from multiprocessing import Pool
-from itertools import chain
+import multiprocessing as mp
 
 tqdm.pandas()
 
@@ -19,153 +18,366 @@ def load_file(file_path):
         result = pickle.load(file)                
     return result
 
-def get_history(group):
-    group_array = np.array(group)
-    histories = []
-    for i in range(len(group_array)):
-        history = group_array[max(0, i - 128 + 1):i + 1]  
-        histories.append(np.pad(history, (128 - len(history), 0), mode='constant'))    
-    return histories
-
-def calculate_ranges(group, k_m, k_s):
-    k_m_delta = relativedelta(months=k_m)
-    k_s_delta = relativedelta(months=k_s)
-    group.set_index('timestamp', inplace=True)
-    
-    def get_mid_len(x):
-        start_time = max(group.index.min(), x - k_m_delta)
-        return group.loc[start_time:x].shape[0] - 1
-
-    def get_short_len(x):
-        start_time = max(group.index.min(), x - k_s_delta)
-        return group.loc[start_time:x].shape[0] - 1
-
-    group['mid_len'] = group.index.to_series().apply(get_mid_len)
-    group['short_len'] = group.index.to_series().apply(get_short_len)
-    group.reset_index(inplace=True)
-
-    return group[['mid_len', 'short_len']]
-
-def generate_negative_samples_for_row(all_item_ids, item_encoded, item_his_encoded_set, num_samples, item_to_cat, pop_dict, unit_time):
-    candidate_items = list(all_item_ids - item_his_encoded_set - {item_encoded})
-    random.shuffle(candidate_items)
-
-    neg_samples = []
-    valid_sample_count = 0
-    for item in candidate_items:
-        if valid_sample_count >= num_samples:
-            break
-
-        key = (item, unit_time)
-        if key in pop_dict:
-            pop_data = pop_dict[key]
-            conformity = pop_data['conformity']
-            quality = pop_data['quality']
-            cat_encoded = item_to_cat.get(item, 0)
-            neg_samples.append({
-                'item_encoded': item,
-                'cat_encoded': int(cat_encoded),
-                'conformity': conformity,
-                'quality': quality
-            })
-            valid_sample_count += 1
-
-    if valid_sample_count < num_samples:
-        neg_samples.extend([{
-            'item_encoded': 0,
-            'cat_encoded': 0,
-            'conformity': 0.0,
-            'quality': 0.0
-        }] * (num_samples - valid_sample_count))
-    
-    return neg_samples
-
-def repeat_column(arr, num_samples):
-    repeated = np.repeat(arr, num_samples)
-    return repeated
-
-def expand_and_assign(df, neg_samples_df, col_name, num_samples):
-    repeated = repeat_column(np.array(df[col_name]), num_samples)
-    repeated_df = pd.DataFrame(repeated, columns=[col_name])
-    neg_samples_df = pd.concat([neg_samples_df.reset_index(drop=True), repeated_df.reset_index(drop=True)], axis=1)
-    return neg_samples_df
-
-def generate_negative_samples_chunk(df_chunk, pop_dict, all_item_ids, num_samples, item_to_cat):
-    chunk_neg_samples = []
-    for idx in tqdm(range(len(df_chunk)), desc="Generating negative samples"):
-        neg_samples = generate_negative_samples_for_row(
-            all_item_ids, df_chunk.iloc[idx]['item_encoded'], df_chunk.iloc[idx]['item_his_encoded_set'], num_samples, item_to_cat, pop_dict, df_chunk.iloc[idx]['unit_time']
-        )
-        chunk_neg_samples.extend(neg_samples)
-    return chunk_neg_samples
-
-def generate_negative_samples_vectorized_parallel(df, pop_dict, all_item_ids, num_samples, item_to_cat, num_workers=8):
-    df_split = np.array_split(df, num_workers * 2)
-    
-    with Pool(num_workers) as pool:
-        results = pool.starmap(generate_negative_samples_chunk, [(chunk, pop_dict, all_item_ids, num_samples, item_to_cat) for chunk in df_split])
-    
-    neg_samples = list(chain.from_iterable(results))
+POP_COLUMNS = ['item_encoded', 'unit_time', 'time_output', 'conformity', 'quality']
+
+# Same layout as HANDOFF_* in popularity/code/storage.py
+HANDOFF_FILE = 'pop_table.f32'
+HANDOFF_MAGIC = b'POPTABLE'
+HANDOFF_VERSION = 2
+HANDOFF_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('num_items', '<u4'), ('max_time', '<u4'), ('item_capacity', '<u4'), ('reserved', 'V40')])
+
+def handoff_slab(item_capacity):
+    return np.dtype([('values', '<f4', (item_capacity, 2)), ('valid', 'u1', (item_capacity,))])
+
+def load_pop_columns(pop_path):
+    """
+    Read the popularity predictions that popularity/code writes column by column
+    (raw .bin files described by meta.json) into a DataFrame.
+    """
+    with open(os.path.join(pop_path, 'meta.json'), 'r') as file:
+        meta = json.load(file)
+    columns = {name: meta['columns'][name] for name in POP_COLUMNS}
+    return pd.DataFrame({
+        name: np.fromfile(os.path.join(pop_path, f'{name}.bin'), dtype=np.dtype(column['dtype']), count=column['length'])
+        for name, column in columns.items()
+    })
+
+HISTORY_LEN = 128
+
+class UserHistories(object):
+    """
+    Every user's interactions stored once as flat item, category, conformity and
+    quality arrays in (user, timestamp) order. A row refers to its history by
+    his_offset (where its user's interactions start) and his_pos (its position
+    among them); the left-padded window of the last length interactions up to
+    and including the row is only gathered when a batch is built.
+    """
+    def __init__(self, item, cat, con, qlt, length=HISTORY_LEN):
+        self.item = item
+        self.cat = cat
+        self.con = con
+        self.qlt = qlt
+        self.length = length
+
+    @classmethod
+    def from_frame(cls, df, length=HISTORY_LEN):
+        """
+        Histories of df, which must be sorted by user_encoded and timestamp, and
+        the his_offset and his_pos of each of its rows.
+        """
+        his_pos = df.groupby('user_encoded').cumcount().to_numpy(dtype=np.int64)
+        his_offset = np.arange(len(df), dtype=np.int64) - his_pos
+        histories = cls(df['item_encoded'].to_numpy(dtype=np.int32), df['cat_encoded'].to_numpy(dtype=np.int32),
+                        df['conformity'].to_numpy(dtype=np.float32), df['quality'].to_numpy(dtype=np.float32), length)
+        return histories, his_offset, his_pos
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as arrays:
+            return cls(arrays['item'], arrays['cat'], arrays['con'], arrays['qlt'], int(arrays['length']))
+
+    def save(self, file_path):
+        np.savez(file_path, item=self.item, cat=self.cat, con=self.con, qlt=self.qlt, length=self.length)
+
+    def indices(self, his_offset, his_pos):
+        """
+        (B, length) positions into the flat arrays and the mask of the ones that
+        belong to the row's user; masked-out positions are left padding.
+        """
+        his_offset = np.asarray(his_offset, dtype=np.int64).reshape(-1, 1)
+        positions = np.asarray(his_pos, dtype=np.int64).reshape(-1, 1) + np.arange(1 - self.length, 1)
+        valid = positions >= 0
+        return his_offset + np.maximum(positions, 0), valid
+
+    def windows(self, his_offset, his_pos):
+        index, valid = self.indices(his_offset, his_pos)
+        return {
+            'item_his': np.where(valid, self.item[index], 0),
+            'cat_his': np.where(valid, self.cat[index], 0),
+            'con_his': np.where(valid, self.con[index], 0),
+            'qlt_his': np.where(valid, self.qlt[index], 0)
+        }
 
-    neg_samples_df = pd.DataFrame(neg_samples)
+    def items(self, his_offset, his_pos):
+        """
+        Items of one row's window as a view, without the padding.
+        """
+        return self.item[his_offset + max(0, his_pos + 1 - self.length):his_offset + his_pos + 1]
+
+    def contains(self, his_offset, his_pos, candidates):
+        """
+        Whether each candidate item is in its row's window. Windows are
+        contiguous ranges of the flat arrays, so every probe is one binary
+        search over the (item, position) keys of all interactions.
+        """
+        if not hasattr(self, '_item_keys'):
+            self._item_keys = np.sort(self.item.astype(np.int64) * len(self.item) + np.arange(len(self.item)))
+        first = np.asarray(his_offset, dtype=np.int64) + np.maximum(np.asarray(his_pos, dtype=np.int64) + 1 - self.length, 0)
+        last = np.asarray(his_offset, dtype=np.int64) + np.asarray(his_pos, dtype=np.int64)
+        candidates = np.asarray(candidates, dtype=np.int64) * len(self.item)
+        found = np.searchsorted(self._item_keys, candidates + first)
+        hit = np.minimum(found, len(self._item_keys) - 1)
+        return (found < len(self._item_keys)) & (self._item_keys[hit] <= candidates + last)
+
+def window_lengths(df, months):
+    """
+    For every row of df, sorted by user_encoded and timestamp, the number of the
+    user's other interactions timestamped from `months` calendar months before
+    the row up to the row (inclusive, ties included). Both bounds are found with
+    one searchsorted over (user, timestamp) keys instead of slicing per row.
+    """
+    users = df['user_encoded'].to_numpy()
+    timestamps = pd.DatetimeIndex(df['timestamp'])
+    # same month arithmetic as relativedelta: day clipped to the shorter month
+    starts = (timestamps - pd.DateOffset(months=months)).as_unit(timestamps.unit)
+
+    # rank all timestamps together so (segment, rank) packs into one sortable int64
+    _, ranks = np.unique(np.concatenate([timestamps.asi8, starts.asi8]), return_inverse=True)
+    segments = np.zeros(len(df), dtype=np.int64)
+    segments[1:] = np.cumsum(users[1:] != users[:-1])
+    keys = segments * (len(ranks) + 1) + ranks[:len(df)]
+    start_keys = segments * (len(ranks) + 1) + ranks[len(df):]
+    return np.searchsorted(keys, keys, side='right') - np.searchsorted(keys, start_keys, side='left') - 1
+
+class NegativeSampler(object):
+    """
+    Negatives for a positive row drawn uniformly without replacement from the
+    items 1..max_item_id that have popularity scores at the row's unit_time,
+    excluding the row's item and its history window. Candidates are drawn by
+    rejection, so a row costs expected O(num_samples) when the exclusions are
+    a small part of the pool; when num_samples is close to the pool size (or
+    rejection keeps failing) the pool is filtered and permuted instead.
+    """
+    def __init__(self, pop_table, max_item_id, max_rounds=4):
+        self.pop_table = pop_table
+        self.max_rounds = max_rounds
+        valid = np.asarray(pop_table.valid[:, 1:max_item_id + 1])
+        # items valid at each unit_time, as a CSR over the time axis
+        times, items = np.nonzero(valid)
+        self.items = (items + 1).astype(np.int64)
+        self.indptr = np.searchsorted(times, np.arange(valid.shape[0] + 1))
+
+    def pool(self, unit_time):
+        if unit_time < 0 or unit_time >= len(self.indptr) - 1:
+            return self.items[:0]
+        return self.items[self.indptr[unit_time]:self.indptr[unit_time + 1]]
+
+    def sample(self, rng, item_encoded, history_items, unit_time, num_samples):
+        pool = self.pool(unit_time)
+        excluded = np.append(history_items, item_encoded)
+        if 2 * num_samples < len(pool):
+            chosen = pool[:0]
+            for _ in range(self.max_rounds):
+                draws = pool[rng.integers(0, len(pool), 2 * (num_samples - len(chosen)) + 8)]
+                chosen = np.concatenate([chosen, draws[~np.isin(draws, excluded)]])
+                _, first = np.unique(chosen, return_index=True)
+                chosen = chosen[np.sort(first)]
+                if len(chosen) >= num_samples:
+                    return chosen[:num_samples]
+        candidates = pool[~np.isin(pool, excluded)]
+        return rng.permutation(candidates)[:num_samples]
+
+    def sample_batch(self, rng, items, unit_times, histories, his_offset, his_pos, num_samples):
+        """
+        sample() for many rows at once, as an (N, num_samples) array padded with
+        item 0. Every open slot draws from its row's pool in one vectorized step
+        and slots holding the row's item, a history item or a repeat are drawn
+        again; rows with small pools or still open after max_rounds go through
+        sample() one by one.
+        """
+        items = np.asarray(items, dtype=np.int64)
+        unit_times = np.asarray(unit_times, dtype=np.int64)
+        his_offset = np.asarray(his_offset, dtype=np.int64)
+        his_pos = np.asarray(his_pos, dtype=np.int64)
+        inside = (unit_times >= 0) & (unit_times < len(self.indptr) - 1)
+        pool_start = self.indptr[np.where(inside, unit_times, 0)]
+        pool_size = np.where(inside, self.indptr[np.where(inside, unit_times + 1, 1)] - pool_start, 0)
+
+        neg_items = np.zeros((len(items), num_samples), dtype=np.int64)
+        open_slots = np.zeros((len(items), num_samples), dtype=bool)
+        open_slots[2 * num_samples < pool_size] = True
+        for _ in range(self.max_rounds):
+            rows, cols = np.nonzero(open_slots)
+            if len(rows) == 0:
+                break
+            draws = self.items[pool_start[rows] + rng.integers(0, pool_size[rows])]
+            rejected = (draws == items[rows]) | histories.contains(his_offset[rows], his_pos[rows], draws)
+            neg_items[rows, cols] = np.where(rejected, 0, draws)
+            repeated = np.zeros_like(open_slots)
+            for col in range(1, num_samples):
+                repeated[:, col] = (neg_items[:, col:col + 1] == neg_items[:, :col]).any(axis=1) & (neg_items[:, col] != 0)
+            neg_items[repeated] = 0
+            open_slots = (neg_items == 0) & (2 * num_samples < pool_size)[:, None]
+
+        for row in np.flatnonzero((2 * num_samples >= pool_size) | open_slots.any(axis=1)):
+            samples = self.sample(rng, items[row], histories.items(his_offset[row], his_pos[row]), unit_times[row], num_samples)
+            neg_items[row] = 0
+            neg_items[row, :len(samples)] = samples
+        return neg_items
+
+# Read-only state of the negative sampling pool, installed in every worker by
+# _init_negative_worker. Under fork the workers inherit it without pickling.
+negative_context = {}
+
+def _init_negative_worker(context):
+    negative_context.update(context)
+
+def generate_negative_samples_chunk(task):
+    """
+    Negatives for rows start..end of the split in negative_context, as an
+    (end - start, num_samples) array of item ids padded with 0.
+    """
+    start, end, seed = task
+    context = negative_context
+    sampler, histories, num_samples = context['sampler'], context['histories'], context['num_samples']
+    rng = np.random.default_rng(seed)
+    neg_items = np.zeros((end - start, num_samples), dtype=np.int32)
+    for row in range(start, end):
+        samples = sampler.sample(rng, context['item_encoded'][row], histories.items(context['his_offset'][row], context['his_pos'][row]),
+                                 context['unit_time'][row], num_samples)
+        neg_items[row - start, :len(samples)] = samples
+    return neg_items
+
+def generate_negative_samples_vectorized_parallel(df, sampler, histories, num_samples, item_to_cat, num_workers=8, seed=2024, chunk_size=1024):
+    """
+    Draw num_samples negatives for every row of df in a process pool. The
+    sampler, histories and row columns are handed to each worker once through
+    the pool initializer; tasks carry only a row range and a seed, and return
+    item ids whose categories and popularity scores are looked up here.
+    Chunks of chunk_size rows each get their own seed, so the result does not
+    depend on num_workers.
+    """
+    context = {
+        'sampler': sampler,
+        'histories': histories,
+        'num_samples': num_samples,
+        'item_encoded': df['item_encoded'].to_numpy(dtype=np.int64),
+        'his_offset': df['his_offset'].to_numpy(dtype=np.int64),
+        'his_pos': df['his_pos'].to_numpy(dtype=np.int64),
+        'unit_time': df['unit_time'].to_numpy(dtype=np.int64)
+    }
+    starts = range(0, len(df), chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = [(start, min(start + chunk_size, len(df)), chunk_seed) for start, chunk_seed in zip(starts, seeds)]
+    if tasks:
+        print(f"{len(tasks)} tasks on {num_workers} workers, {len(pickle.dumps(tasks[0]))} bytes serialized per task")
+
+    if num_workers <= 1:
+        _init_negative_worker(context)
+        results = [generate_negative_samples_chunk(task) for task in tqdm(tasks, desc="Generating negative samples")]
+    else:
+        with mp.get_context('fork').Pool(num_workers, initializer=_init_negative_worker, initargs=(context,)) as pool:
+            results = list(tqdm(pool.imap(generate_negative_samples_chunk, tasks), total=len(tasks), desc="Generating negative samples"))
+    neg_items = np.concatenate(results).reshape(-1) if results else np.zeros(0, dtype=np.int32)
 
-    if len(neg_samples) != len(df) * num_samples:
+    if len(neg_items) != len(df) * num_samples:
         raise ValueError("The length of the negative samples does not match the expected length.")
 
-    indices = np.repeat(np.arange(len(df)), num_samples)
-
+    return negative_rows(df, neg_items.reshape(len(df), num_samples), sampler, item_to_cat)
+
+def negative_rows(df, neg_items, sampler, item_to_cat):
+    """
+    Rows for the (len(df), num_samples) negative items of df's rows; item 0
+    marks a missing negative and is dropped.
+    """
+    indices = np.repeat(np.arange(len(df)), neg_items.shape[1])
+    neg_items = neg_items.reshape(-1)
+    keep = neg_items != 0
+    neg_items, indices = neg_items[keep].astype(np.int64), indices[keep]
+    unit_times = df['unit_time'].values[indices]
+    conformity, quality, _ = sampler.pop_table.lookup(neg_items, unit_times)
+
+    neg_samples_df = pd.DataFrame({
+        'item_encoded': neg_items,
+        'cat_encoded': pd.Series(neg_items).map(item_to_cat).fillna(0).to_numpy(dtype=np.int64),
+        'conformity': conformity,
+        'quality': quality
+    })
+    # negatives share the positive row's history window through its (offset, position)
     neg_samples_df['user_encoded'] = df['user_encoded'].values[indices]    
-    
-    neg_samples_df = expand_and_assign(df, neg_samples_df, 'item_his_encoded', num_samples)
-    neg_samples_df = expand_and_assign(df, neg_samples_df, 'cat_his_encoded', num_samples)
-    neg_samples_df = expand_and_assign(df, neg_samples_df, 'con_his', num_samples)
-    neg_samples_df = expand_and_assign(df, neg_samples_df, 'qlt_his', num_samples)
-
-    neg_samples_df['item_his_encoded_set'] = df['item_his_encoded_set'].values[indices]
-    neg_samples_df['unit_time'] = df['unit_time'].values[indices]
+    neg_samples_df['his_offset'] = df['his_offset'].values[indices]
+    neg_samples_df['his_pos'] = df['his_pos'].values[indices]
+    neg_samples_df['unit_time'] = unit_times
     neg_samples_df['mid_len'] = df['mid_len'].values[indices]
     neg_samples_df['short_len'] = df['short_len'].values[indices]
     neg_samples_df['label'] = 0
 
-    neg_samples_df = neg_samples_df[neg_samples_df['item_encoded'] != 0]
-
     return neg_samples_df
 
     
-def create_pop_dict(df_pop):
-    pop_dict = {}
-    for index, row in df_pop.iterrows():
-        key = (row['item_encoded'], row['unit_time'])
-        pop_dict[key] = {'conformity': row['conformity'], 'quality': row['quality']}
-    return pop_dict
-
-def preprocess_df(df, df_pop, config):
+class PopTable(object):
+    """
+    Dense (max_time + 1, num_items, 2) float32 table of conformity and quality
+    with a validity mask, so (item, unit_time) probes are vectorized array
+    lookups. Built from a popularity frame in one scatter, or memory-mapped from
+    the handoff file popularity/code writes next to its prediction columns.
+    """
+    def __init__(self, values, valid):
+        self.values = values
+        self.valid = valid
+
+    @classmethod
+    def from_frame(cls, df_pop):
+        items = df_pop['item_encoded'].to_numpy(dtype=np.int64)
+        unit_times = df_pop['unit_time'].to_numpy(dtype=np.int64)
+        num_items = int(items.max()) + 1 if len(items) else 1
+        num_times = int(unit_times.max()) + 1 if len(unit_times) else 1
+        values = np.zeros((num_times, num_items, 2), dtype=np.float32)
+        valid = np.zeros((num_times, num_items), dtype=bool)
+        # older pop_{dataset}.pkl files hold 1-element arrays instead of floats
+        values[unit_times, items, 0] = np.asarray(df_pop['conformity'].tolist(), dtype=np.float32).reshape(-1)
+        values[unit_times, items, 1] = np.asarray(df_pop['quality'].tolist(), dtype=np.float32).reshape(-1)
+        valid[unit_times, items] = True
+        return cls(values, valid)
+
+    @classmethod
+    def open(cls, handoff_path):
+        header = np.fromfile(handoff_path, dtype=HANDOFF_HEADER, count=1)
+        if len(header) == 0 or header['magic'][0] != HANDOFF_MAGIC:
+            raise ValueError(f"{handoff_path} is not a popularity handoff file")
+        if header['version'][0] != HANDOFF_VERSION:
+            raise ValueError(f"Unsupported handoff version {header['version'][0]} in {handoff_path}, rerun popularity/code/predict.py")
+        num_items, num_times = int(header['num_items'][0]), int(header['max_time'][0]) + 1
+        slabs = np.memmap(handoff_path, dtype=handoff_slab(int(header['item_capacity'][0])), mode='r',
+                          offset=HANDOFF_HEADER.itemsize, shape=(num_times,))
+        return cls(slabs['values'][:, :num_items], slabs['valid'][:, :num_items].view(np.bool_))
+
+    def lookup(self, items, unit_times):
+        """
+        Conformity and quality of the given pairs (NaN where the popularity
+        output has no row, like a left merge) and the validity mask.
+        """
+        items = np.asarray(items, dtype=np.int64)
+        unit_times = np.asarray(unit_times, dtype=np.int64)
+        num_times, num_items = self.valid.shape
+        inside = (items >= 0) & (items < num_items) & (unit_times >= 0) & (unit_times < num_times)
+        items = np.where(inside, items, 0)
+        unit_times = np.where(inside, unit_times, 0)
+        valid = inside & self.valid[unit_times, items]
+        values = self.values[unit_times, items]
+        values[~valid] = np.nan
+        return values[..., 0], values[..., 1], valid
+
+def preprocess_df(df, pop_table, config):
     df = df.copy()
     df = df.sort_values(by=['user_encoded', 'timestamp'])
     item_to_cat = df.set_index('item_encoded')['cat_encoded'].to_dict()
-    pop_dict = create_pop_dict(df_pop)
 
     max_time = df["unit_time"].max()
     print("max_time", max_time)
-    df = df.merge(df_pop, on=['item_encoded', 'unit_time'], how='left')
-
-    df['item_his_encoded'] = df.groupby('user_encoded')['item_encoded'].transform(get_history)
-    df['cat_his_encoded'] = df.groupby('user_encoded')['cat_encoded'].transform(get_history)
-    df['con_his'] = df.groupby('user_encoded')['conformity'].transform(get_history)
-    df['qlt_his'] = df.groupby('user_encoded')['quality'].transform(get_history)
+    df['conformity'], df['quality'], _ = pop_table.lookup(df['item_encoded'], df['unit_time'])
 
-    df['item_his_encoded_set'] = df['item_his_encoded'].apply(set)
+    histories, df['his_offset'], df['his_pos'] = UserHistories.from_frame(df)
     df['label'] = 1
 
     max_item_id = df['item_encoded'].max()
-    all_item_ids = set(range(1, max_item_id + 1))
+    sampler = NegativeSampler(pop_table, max_item_id)
 
-    ranges_df = df.groupby('user_encoded', group_keys=False).apply(lambda x: calculate_ranges(x, config.k_m, config.k_s), include_groups=False)
     df.reset_index(drop=True, inplace=True)
-    ranges_df.reset_index(drop=True, inplace=True)
-    df = pd.concat([df, ranges_df], axis=1)
+    df['mid_len'] = window_lengths(df, config.k_m)
+    df['short_len'] = window_lengths(df, config.k_s)
 
-    df = df[['user_encoded', 'item_encoded', 'cat_encoded', 'conformity', 'quality', 'item_his_encoded', 'item_his_encoded_set', 'cat_his_encoded', 'con_his', 'qlt_his', 'timestamp', 'unit_time', 'mid_len', 'short_len', 'label']]
+    df = df[['user_encoded', 'item_encoded', 'cat_encoded', 'conformity', 'quality', 'his_offset', 'his_pos', 'timestamp', 'unit_time', 'mid_len', 'short_len', 'label']]
 
     # if config.dataset == 'MovieLens_1M': # fix
     #     train_df = df[df['unit_time'] < 8].reset_index(drop=True)
@@ -236,13 +448,17 @@ def preprocess_df(df, df_pop, config):
     del df
     gc.collect()
 
-    print("Generating negative samples for train dataset")
-    train_neg_df = generate_negative_samples_vectorized_parallel(train_df, pop_dict, all_item_ids, config.train_num_samples, item_to_cat)
+    if config.online_negatives:
+        # NegativeSamplingDataset draws fresh train negatives every epoch
+        train_neg_df = train_df.iloc[:0]
+    else:
+        print("Generating negative samples for train dataset")
+        train_neg_df = generate_negative_samples_vectorized_parallel(train_df, sampler, histories, config.train_num_samples, item_to_cat, config.preprocess_workers)
     print("Generating negative samples for valid dataset")
-    valid_neg_df = generate_negative_samples_vectorized_parallel(valid_df, pop_dict, all_item_ids, config.valid_num_samples, item_to_cat)
+    valid_neg_df = generate_negative_samples_vectorized_parallel(valid_df, sampler, histories, config.valid_num_samples, item_to_cat, config.preprocess_workers)
     print("Generating negative samples for test dataset")
-    test_neg_df = generate_negative_samples_vectorized_parallel(test_df, pop_dict, all_item_ids, max_item_id + 1, item_to_cat)
-    # test_neg_df = generate_negative_samples_vectorized_parallel(test_df, pop_dict, all_item_ids, config.test_num_samples, item_to_cat)
+    test_neg_df = generate_negative_samples_vectorized_parallel(test_df, sampler, histories, max_item_id + 1, item_to_cat, config.preprocess_workers)
+    # test_neg_df = generate_negative_samples_vectorized_parallel(test_df, pop_table, all_item_ids, config.test_num_samples, item_to_cat)
 
     train_df = pd.concat([train_df, train_neg_df], ignore_index=True)
     valid_df = pd.concat([valid_df, valid_neg_df], ignore_index=True)
@@ -253,58 +469,97 @@ def preprocess_df(df, df_pop, config):
     gc.collect()
     torch.cuda.empty_cache()
 
-    return train_df, valid_df, test_df
+    return train_df, valid_df, test_df, histories
 
 class LazyDataset(Dataset):
-    def __init__(self, df):
-        self.df = df
+    """
+    Rows of a preprocessed split. History windows are gathered from the shared
+    UserHistories for a whole batch at a time in __getitems__, so no row holds
+    its own padded copies.
+    """
+    def __init__(self, df, histories):
+        self.histories = histories
+        self._set_rows(df)
+
+    def _set_rows(self, df):
+        self.columns = {
+            'user': df['user_encoded'].to_numpy(dtype=np.int64),
+            'item': df['item_encoded'].to_numpy(dtype=np.int64),
+            'cat': df['cat_encoded'].to_numpy(dtype=np.int64),
+            'con': df['conformity'].to_numpy(dtype=np.float32),
+            'qlt': df['quality'].to_numpy(dtype=np.float32),
+            'mid_len': df['mid_len'].to_numpy(dtype=np.int32),
+            'short_len': df['short_len'].to_numpy(dtype=np.int32),
+            'label': df['label'].to_numpy(dtype=np.int64)
+        }
+        self.his_offset = df['his_offset'].to_numpy(dtype=np.int64)
+        self.his_pos = df['his_pos'].to_numpy(dtype=np.int64)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.his_pos)
     
     def __getitem__(self, idx):
-        user = torch.tensor(self.df['user_encoded'].iloc[idx], dtype=torch.long)
-        item = torch.tensor(self.df['item_encoded'].iloc[idx], dtype=torch.long)
-        cat = torch.tensor(self.df['cat_encoded'].iloc[idx], dtype=torch.long)
-        con = torch.tensor(self.df['conformity'].iloc[idx], dtype=torch.float)
-        qlt = torch.tensor(self.df['quality'].iloc[idx], dtype=torch.float)
-        item_his = torch.tensor(self.df['item_his_encoded'].iloc[idx], dtype=torch.long)
-        cat_his = torch.tensor(self.df['cat_his_encoded'].iloc[idx], dtype=torch.long)
-        con_his = torch.tensor(self.df['con_his'].iloc[idx], dtype=torch.float)
-        qlt_his = torch.tensor(self.df['qlt_his'].iloc[idx], dtype=torch.float)
-        mid_len = torch.tensor(self.df['mid_len'].iloc[idx], dtype=torch.int)
-        short_len = torch.tensor(self.df['short_len'].iloc[idx], dtype=torch.int)
-        label = torch.tensor(self.df['label'].iloc[idx], dtype=torch.long)
-        
-        data = {
-            'user': user,
-            'item': item,
-            'cat': cat,
-            'con': con,
-            'qlt': qlt,
-            'item_his': item_his,
-            'cat_his': cat_his,
-            'con_his': con_his,
-            'qlt_his': qlt_his,
-            'mid_len': mid_len,
-            'short_len': short_len,
-            'label': label
-        }
+        return {k: v[0] for k, v in self.__getitems__([idx]).items()}
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        data = {k: torch.from_numpy(v[indices]) for k, v in self.columns.items()}
+        windows = self.histories.windows(self.his_offset[indices], self.his_pos[indices])
+        data['item_his'] = torch.from_numpy(windows['item_his']).long()
+        data['cat_his'] = torch.from_numpy(windows['cat_his']).long()
+        data['con_his'] = torch.from_numpy(windows['con_his'])
+        data['qlt_his'] = torch.from_numpy(windows['qlt_his'])
         return data
 
-def create_dataloader(train_df, valid_df, test_df, batch_size=32, num_workers=4):
+class NegativeSamplingDataset(LazyDataset):
+    """
+    Positive rows of a split with num_samples negatives per positive that are
+    redrawn by resample(epoch) instead of being stored. Draws are seeded by
+    (seed, epoch), so an epoch sees the same negatives in every run, and asking
+    again for the epoch already drawn keeps its rows.
+    """
+    def __init__(self, df, histories, sampler, item_to_cat, num_samples, seed=2024):
+        self.histories = histories
+        self.positives = df[df['label'] == 1].reset_index(drop=True)
+        self.sampler = sampler
+        self.item_to_cat = item_to_cat
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = None
+        self.resample(0)
+
+    def resample(self, epoch):
+        if epoch == self.epoch:
+            return
+        rng = np.random.default_rng([self.seed, epoch])
+        positives = self.positives
+        neg_items = self.sampler.sample_batch(rng, positives['item_encoded'].to_numpy(), positives['unit_time'].to_numpy(), self.histories,
+                                              positives['his_offset'].to_numpy(), positives['his_pos'].to_numpy(), self.num_samples)
+        neg_df = negative_rows(positives, neg_items, self.sampler, self.item_to_cat)
+        self._set_rows(pd.concat([positives, neg_df], ignore_index=True))
+        self.epoch = epoch
+
+def collate_batch(batch):
+    # LazyDataset.__getitems__ already returns the collated batch
+    return batch
+
+def create_dataloader(train_df, valid_df, test_df, histories, batch_size=32, num_workers=4, sampler=None, item_to_cat=None, num_samples=4):
     print("making train dataset")
-    train_dataset = LazyDataset(train_df)
+    if sampler is not None:
+        # without persistent workers, each epoch's workers fork after resample()
+        train_dataset = NegativeSamplingDataset(train_df, histories, sampler, item_to_cat, num_samples)
+    else:
+        train_dataset = LazyDataset(train_df, histories)
     print("making valid dataset")
-    valid_dataset = LazyDataset(valid_df)
+    valid_dataset = LazyDataset(valid_df, histories)
     print("making test dataset")
-    test_dataset = LazyDataset(test_df)
+    test_dataset = LazyDataset(test_df, histories)
     print("test_dataset")
 
     print("creating dataloaders")
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, collate_fn=collate_batch)
+    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_batch)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=collate_batch)
 
     print("create datasets and dataloaders done!")
     return train_loader, valid_loader, test_loader
\ No newline at end of file
@@ -236,3 +236,31 @@ class EarlyStopping:
                 print(f'EarlyStopping counter: {self.counter} out of {self.patience}')
             if self.counter >= self.patience:
                 self.early_stop = True
+
+
+class SuccessiveHalving:
+    """
+    Successive halving across the grid trials run one after another. Trials
+    report their validation loss at the milestones min_epochs * reduction_factor**k,
+    and a trial outside the best 1/reduction_factor of the losses recorded at
+    that milestone so far is pruned.
+    """
+    def __init__(self, max_epochs, reduction_factor=3, min_epochs=2, verbose=False):
+        self.reduction_factor = reduction_factor
+        self.verbose = verbose
+        self.milestones = []
+        milestone = max(min_epochs, 1)
+        while reduction_factor > 1 and milestone < max_epochs:
+            self.milestones.append(milestone)
+            milestone *= reduction_factor
+        self.rungs = {}
+
+    def __call__(self, epochs_run, val_loss):
+        if epochs_run not in self.milestones:
+            return False
+        losses = self.rungs.setdefault(epochs_run, [])
+        losses.append(val_loss)
+        cutoff = np.percentile(losses, 100 / self.reduction_factor)
+        if self.verbose:
+            print(f'SuccessiveHalving milestone {epochs_run}: loss {val_loss:.4f}, cutoff {cutoff:.4f} over {len(losses)} trials')
+        return val_loss > cutoff
@@ -1,18 +1,118 @@
+import os
+import copy
+
+import numpy as np
 import torch
 import torch.nn as nn
 from config import Config
 import torch.nn.functional as F
+from tqdm import tqdm
+
+from storage import create_columns, write_column, write_meta, write_handoff, PREDICTION_COLUMNS, HANDOFF_FILE
 
 torch.manual_seed(2024)
 torch.cuda.manual_seed(2024)
 
+def ema_scan(pop_counts, alpha, start_time=0, initial=None):
+    """
+    Exponential moving average of every item's popularity history along the time
+    axis, computed once for all items with one vectorized step per time unit.
+    Only the non-zero counts of each time unit are read from pop_counts.
+    With initial, the scan resumes from the EMA values at start_time (row 0 of
+    the result) instead of rescanning the history before it.
+    """
+    items = torch.from_numpy(np.asarray(pop_counts.items, dtype=np.int64))
+    counts = torch.from_numpy(np.asarray(pop_counts.counts, dtype=np.float32))
+    indptr = pop_counts.indptr
+    num_items, num_times = pop_counts.shape
+
+    ema_all = torch.zeros(num_times - start_time, num_items)
+    if initial is not None:
+        initial = torch.from_numpy(np.asarray(initial, dtype=np.float32))
+        ema_all[0, :len(initial)] = initial
+    for t in range(start_time + (initial is not None), num_times):
+        row = t - start_time
+        weight = 1.0
+        if row > 0:
+            torch.mul(ema_all[row-1], 1 - alpha, out=ema_all[row])
+            weight = alpha
+        start, end = indptr[t], indptr[t+1]
+        ema_all[row].index_add_(0, items[start:end], counts[start:end], alpha=weight)
+    return ema_all.t().contiguous()
+
+def score_chunks(model, item_columns, first_times, max_time, device, chunk_size=65536):
+    """
+    Yield the outputs of PopPredict.score_dense for every item at unit_times
+    first_times[i]..max_time, chunk_size items at a time, as numpy columns in
+    item-major order. The number of rows of each chunk is known in advance
+    from first_times, so callers can write chunks straight to disk.
+    """
+    first_times = np.asarray(first_times, dtype=np.int64)
+    for start in range(0, len(first_times), chunk_size):
+        end = min(start + chunk_size, len(first_times))
+        columns = {k: torch.tensor(np.asarray(item_columns[k][start:end]), dtype=torch.long, device=device)
+                   for k in ['item_encoded', 'release_time', 'cat_encoded', 'store_encoded']}
+        chunk_first = torch.from_numpy(first_times[start:end]).to(device)
+        times = torch.arange(int(first_times[start:end].min()), max_time + 1, device=device)
+        pop_history, time_output, sideinfo = model.score_dense(
+            columns['item_encoded'], columns['release_time'], columns['cat_encoded'], columns['store_encoded'], times)
+        valid = times.unsqueeze(0) >= chunk_first.unsqueeze(1)
+        item_index, time_index = valid.nonzero(as_tuple=True)
+
+        yield {
+            'item_encoded': columns['item_encoded'][item_index].cpu().numpy(),
+            'unit_time': times[time_index].cpu().numpy(),
+            'time_output': time_output[valid].cpu().numpy(),
+            'conformity': (pop_history + time_output)[valid].cpu().numpy(),
+            'quality': sideinfo[valid].cpu().numpy()
+        }
+
+def generate_outputs(model, item_columns, max_time, device, result_path, history_revision=0, chunk_size=65536):
+    """
+    Score every (item, unit_time) pair from release_time to max_time and stream
+    the chunks from score_chunks into preallocated columns at result_path, in
+    the row order of expand_items. The EMA state at max_time is saved with them
+    so later unit_times can be scored incrementally, and the dense handoff table
+    the interest pipeline memory-maps is written alongside.
+
+    predict.py --refresh appends one block per refresh after these rows, item-
+    major over that refresh's new unit_times only, so an item's rows are not
+    contiguous once the columns have been refreshed. Join on item_encoded and
+    unit_time (or use the handoff table) rather than relying on row positions.
+    """
+    model.eval()
+    release_times = np.asarray(item_columns['release_time'], dtype=np.int64)
+    num_rows = int((max_time + 1 - release_times).sum())
+    meta, outputs = create_columns(result_path, PREDICTION_COLUMNS, num_rows, {'max_time': int(max_time)})
+
+    row = 0
+    with torch.no_grad():
+        chunks = score_chunks(model, item_columns, release_times, max_time, device, chunk_size)
+        for chunk in tqdm(chunks, total=-(-len(release_times) // chunk_size), desc="Generating Outputs"):
+            chunk_rows = len(chunk['unit_time'])
+            for name in PREDICTION_COLUMNS:
+                outputs[name][row:row + chunk_rows] = chunk[name]
+            row += chunk_rows
+
+    for column in outputs.values():
+        if isinstance(column, np.memmap):
+            column.flush()
+    write_handoff(os.path.join(result_path, HANDOFF_FILE), outputs, max_time)
+    write_column(result_path, meta, 'ema_state', model.module_pop_history.ema_state(max_time).cpu().numpy())
+    meta.update(alpha=model.module_pop_history.alpha, num_scored_items=len(release_times), history_revision=history_revision)
+    write_meta(result_path, meta)
+    return meta
+
 class ModulePopHistory(nn.Module):
     def __init__(self, config: Config):
         super(ModulePopHistory, self).__init__()
         self.config = config
-        self.alpha = self.config.alpha
-        self.ema_cache = {}
+        self._alpha = self.config.alpha
         self.sigmoid = nn.Sigmoid()
+        self.pop_counts = None
+        # unit_time of column 0 of ema_table when it was resumed from a saved state
+        self.time_offset = 0
+        self.register_buffer('ema_table', None, persistent=False)
         self._init_weights()
     
     def _init_weights(self):
@@ -22,29 +122,55 @@ class ModulePopHistory(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0.1)
 
-    def ema(self, pop_history, item_id):
-        if item_id in self.ema_cache:
-            return self.ema_cache[item_id]
+    @property
+    def alpha(self):
+        return self._alpha
 
-        alpha = self.alpha
-        ema_all = torch.zeros_like(pop_history, dtype=torch.float)
-        ema_all[:, 0] = pop_history[:, 0]
+    @alpha.setter
+    def alpha(self, alpha):
+        if alpha != self._alpha:
+            self._alpha = alpha
+            self._build_ema_table()
 
-        for t in range(1, pop_history.size(1)):
-            ema_all[:, t] = (1 - alpha) * ema_all[:, t-1] + alpha * pop_history[:, t]
+    def set_pop_counts(self, pop_counts):
+        self.pop_counts = pop_counts
+        self.time_offset = 0
+        self._build_ema_table()
 
-        self.ema_cache[item_id] = ema_all
-        # print("ema_all[0]:\n", ema_all[0])
-        return ema_all
+    def set_ema_state(self, pop_counts, ema_state, state_time):
+        """
+        Continue the EMA from its saved per-item values at state_time, so only
+        the time units after it are scanned. Lookups before state_time return
+        the state itself.
+        """
+        self.pop_counts = pop_counts
+        device = self.ema_table.device if self.ema_table is not None else None
+        with torch.no_grad():
+            self.ema_table = ema_scan(pop_counts, self._alpha, start_time=state_time, initial=ema_state).to(device)
+        self.time_offset = state_time
 
-    def forward(self, pop_history, item_id, time):
-        history_ema = self.ema(pop_history, item_id)
-        time_before = time - 1
+    def ema_state(self, time):
+        return self.ema_table[:, time - self.time_offset]
+
+    def _build_ema_table(self):
+        if self.pop_counts is None:
+            return
+        device = self.ema_table.device if self.ema_table is not None else None
+        with torch.no_grad():
+            self.ema_table = ema_scan(self.pop_counts, self._alpha).to(device)
+        self.time_offset = 0
+
+    def forward(self, item_id, time):
+        time_before = time - 1 - self.time_offset
         time_before_clamped = torch.clamp(time_before, min=0)
-        history_final = torch.gather(history_ema, 1, time_before_clamped.long().unsqueeze(1))
+        history_final = self.ema_table[item_id.long(), time_before_clamped.long()].unsqueeze(1)
         # print("history_final[0]:\n", history_final[0])
         return history_final
 
+    def forward_sequence(self, item_id, times):
+        time_before_clamped = torch.clamp(times - 1 - self.time_offset, min=0)
+        return self.ema_table[item_id.long()][:, time_before_clamped.long()]
+
 class ModuleTime(nn.Module):
     def __init__(self, config: Config):
         super(ModuleTime, self).__init__()
@@ -62,6 +188,25 @@ class ModuleTime(nn.Module):
         time_final = self.relu(self.fc_time_value(item_temp_embed))
         return time_final
 
+    def forward_sequence(self, item_embeds, time_release_embeds, time_embeds):
+        # item-level embeddings are (B, D) and time_embeds is (T, D): broadcast to (B, T, 4D)
+        shape = (item_embeds.size(0), time_embeds.size(0), item_embeds.size(1))
+        item_embeds = item_embeds.unsqueeze(1).expand(shape)
+        time_release_embeds = time_release_embeds.unsqueeze(1).expand(shape)
+        time_embeds = time_embeds.unsqueeze(0).expand(shape)
+        temporal_gap = time_release_embeds - time_embeds
+        item_temp_embed = torch.cat((temporal_gap, item_embeds, time_embeds, time_release_embeds), 2)
+        time_final = self.relu(self.fc_time_value(item_temp_embed))
+        return time_final.squeeze(2)
+
+    def score_dense(self, item_embeds, time_release_embeds, time_embeds):
+        # fc_time_value is linear in its four concatenated blocks, so with
+        # temporal_gap = release - time it splits into an item term and a time term
+        w_gap, w_item, w_time, w_release = self.fc_time_value.weight.squeeze(0).chunk(4)
+        item_term = item_embeds @ w_item + time_release_embeds @ (w_gap + w_release)
+        time_term = time_embeds @ (w_time - w_gap) + self.fc_time_value.bias
+        return self.relu(item_term.unsqueeze(1) + time_term.unsqueeze(0))
+
 class ModuleSideInfo(nn.Module):
     def __init__(self, config: Config):
         super(ModuleSideInfo, self).__init__()
@@ -82,7 +227,7 @@ class ModuleSideInfo(nn.Module):
         return embed_sideinfo
 
 class PopPredict(nn.Module):
-    def __init__(self, config: Config, num_items, num_cats, num_stores, max_time):
+    def __init__(self, config: Config, num_items, num_cats, num_stores, max_time, pop_counts=None):
         super(PopPredict, self).__init__()
 
         self.config = config
@@ -98,6 +243,8 @@ class PopPredict(nn.Module):
         self.module_pop_history = ModulePopHistory(config=config)
         self.module_time = ModuleTime(config=config)
         self.module_sideinfo = ModuleSideInfo(config=config)
+        if pop_counts is not None:
+            self.module_pop_history.set_pop_counts(pop_counts)
 
         # Attention mechanism
         self.attention_weights = nn.Parameter(torch.ones(3, 1) / 3)
@@ -110,22 +257,46 @@ class PopPredict(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path, config, pop_counts=None, map_location='cpu'):
+        """
+        Rebuild the model saved by main.py with the table sizes and embedding_dim
+        stored in the checkpoint, and load every weight strictly. Items, categories
+        and stores added to the store after training go through embedding_ids.
+        """
+        checkpoint = torch.load(checkpoint_path, map_location=map_location)
+        state_dict = {k[7:] if k.startswith('module.') else k: v for k, v in checkpoint['model_state_dict'].items()}
+        config = copy.copy(config)
+        config.embedding_dim = checkpoint['embedding_dim']
+        model = cls(config, state_dict['item_embedding.weight'].shape[0] - 1, state_dict['cat_embedding.weight'].shape[0] - 1,
+                    state_dict['store_embedding.weight'].shape[0] - 1, state_dict['time_embedding.weight'].shape[0] - 1)
+        model.load_state_dict(state_dict)
+        if pop_counts is not None:
+            model.module_pop_history.set_pop_counts(pop_counts)
+        return model
+
+    def embedding_ids(self, items, categories, stores, times):
+        # Items, categories and stores added after training fall back to index 0
+        # and unit_times past the trained range to the last time embedding
+        items = items.masked_fill(items >= self.item_embedding.num_embeddings, 0)
+        categories = categories.masked_fill(categories >= self.cat_embedding.num_embeddings, 0)
+        stores = stores.masked_fill(stores >= self.store_embedding.num_embeddings, 0)
+        return items, categories, stores, times.clamp(max=self.time_embedding.num_embeddings - 1)
+
     def forward(self, batch):
         item_ids = batch['item']
         times = batch['time']
         release_times = batch['release_time']
-        pop_histories = batch['pop_history']
-        categories = batch['category']
-        stores = batch['store']
 
-        item_embeds = self.item_embedding(item_ids)
-        time_embeds = self.time_embedding(times)
-        release_time_embeds = self.time_embedding(release_times)
+        embed_items, categories, stores, embed_times = self.embedding_ids(item_ids, batch['category'], batch['store'], times)
+        item_embeds = self.item_embedding(embed_items)
+        time_embeds = self.time_embedding(embed_times)
+        release_time_embeds = self.time_embedding(release_times.clamp(max=self.time_embedding.num_embeddings - 1))
         cat_embeds = self.cat_embedding(categories)
         store_embeds = self.store_embedding(stores)
 
         # Module outputs
-        pop_history_output = self.module_pop_history(pop_histories, item_ids, times)
+        pop_history_output = self.module_pop_history(item_ids, times)
         time_output = self.module_time(item_embeds, release_time_embeds, time_embeds)
         sideinfo_output = self.module_sideinfo(cat_embeds, store_embeds)
 
@@ -144,3 +315,124 @@ class PopPredict(nn.Module):
         # if not self.is_training:
         #     print('Attention weights:', normalized_weights.data.cpu().numpy())
         return weighted_pop_history_output, weighted_time_output, weighted_sideinfo_output, output
+
+    def forward_sequence(self, batch, times):
+        """
+        Score every item of an ItemSequenceDataset batch at all given times in
+        one pass. Item, category and store embeddings are computed once per item
+        and outputs are (B, T) instead of (B, 1).
+        """
+        item_ids = batch['item']
+        release_times = batch['release_time']
+
+        item_embeds = self.item_embedding(item_ids)
+        time_embeds = self.time_embedding(times)
+        release_time_embeds = self.time_embedding(release_times)
+        cat_embeds = self.cat_embedding(batch['category'])
+        store_embeds = self.store_embedding(batch['store'])
+
+        pop_history_output = self.module_pop_history.forward_sequence(item_ids, times)
+        time_output = self.module_time.forward_sequence(item_embeds, release_time_embeds, time_embeds)
+        sideinfo_output = self.module_sideinfo(cat_embeds, store_embeds).expand(-1, len(times))
+
+        normalized_weights = F.softmax(self.attention_weights, dim=0)
+
+        weighted_pop_history_output = pop_history_output * normalized_weights[0]
+        weighted_time_output = time_output * normalized_weights[1]
+        weighted_sideinfo_output = sideinfo_output * normalized_weights[2]
+        output = weighted_pop_history_output + weighted_time_output + weighted_sideinfo_output
+
+        return weighted_pop_history_output, weighted_time_output, weighted_sideinfo_output, output
+
+    def score_dense(self, items, release_times, categories, stores, times):
+        """
+        Weighted pop_history, time and sideinfo outputs of the given items at every
+        given time as (N, T) tensors, without running the (item, time) rows
+        through forward. The pop_history term is a slice of the EMA table, the
+        time term is separable into item and time parts, and the sideinfo term is
+        computed once per distinct (category, store) pair.
+        """
+        pop_history_output = self.module_pop_history.forward_sequence(items, times)
+        items, categories, stores, embed_times = self.embedding_ids(items, categories, stores, times)
+        release_times = release_times.clamp(max=self.time_embedding.num_embeddings - 1)
+        time_output = self.module_time.score_dense(self.item_embedding(items), self.time_embedding(release_times),
+                                                   self.time_embedding(embed_times))
+
+        side_pairs, side_index = torch.unique(torch.stack((categories, stores), 1), dim=0, return_inverse=True)
+        side_output = self.module_sideinfo(self.cat_embedding(side_pairs[:, 0]), self.store_embedding(side_pairs[:, 1]))
+        sideinfo_output = side_output[side_index].expand(-1, len(times))
+
+        normalized_weights = F.softmax(self.attention_weights, dim=0)
+        return (pop_history_output * normalized_weights[0], time_output * normalized_weights[1],
+                sideinfo_output * normalized_weights[2])
+
+class PopScorer(nn.Module):
+    """
+    Frozen, self-contained inference form of a trained PopPredict for export with
+    torch.jit.script. The EMA table, the per-item release_time, category and
+    store, the embeddings and the softmaxed attention weights are baked in as
+    buffers, so scoring needs only (item, unit_time) pairs and no store, config
+    or training code. Pairs of unknown items or outside 0..max_time score NaN.
+    """
+    def __init__(self, model: PopPredict, item_columns, max_time: int):
+        super(PopScorer, self).__init__()
+        history = model.module_pop_history
+        item_ids = torch.as_tensor(np.asarray(item_columns['item_encoded'], dtype=np.int64))
+        num_items = max(int(item_ids.max()) + 1 if len(item_ids) else 1, history.ema_table.size(0))
+        with torch.no_grad():
+            for name in ['release_time', 'cat_encoded', 'store_encoded']:
+                table = torch.full((num_items,), -1, dtype=torch.long)
+                table[item_ids] = torch.as_tensor(np.asarray(item_columns[name], dtype=np.int64))
+                self.register_buffer(name, table)
+            self.register_buffer('ema_table', history.ema_table.detach().cpu().clone())
+            self.register_buffer('item_weight', model.item_embedding.weight.detach().cpu().clone())
+            self.register_buffer('cat_weight', model.cat_embedding.weight.detach().cpu().clone())
+            self.register_buffer('store_weight', model.store_embedding.weight.detach().cpu().clone())
+            self.register_buffer('time_weight', model.time_embedding.weight.detach().cpu().clone())
+            self.register_buffer('fc_time_weight', model.module_time.fc_time_value.weight.detach().cpu().clone())
+            self.register_buffer('fc_time_bias', model.module_time.fc_time_value.bias.detach().cpu().clone())
+            self.register_buffer('fc_side_weight', model.module_sideinfo.fc_output.weight.detach().cpu().clone())
+            self.register_buffer('fc_side_bias', model.module_sideinfo.fc_output.bias.detach().cpu().clone())
+            self.register_buffer('attention', F.softmax(model.attention_weights.detach().cpu(), dim=0).squeeze(1).clone())
+        self.time_offset = int(history.time_offset)
+        self.max_time = int(max_time)
+
+    @torch.jit.export
+    def known_items(self):
+        return torch.nonzero(self.release_time >= 0).squeeze(1)
+
+    def _embedding_ids(self, ids, weight):
+        return ids.masked_fill(ids >= weight.size(0), 0)
+
+    def forward(self, items, unit_times):
+        """
+        Conformity (weighted pop_history + time output) and quality (weighted
+        sideinfo output) of every (items[i], unit_times[i]) pair as 1-D tensors.
+        """
+        items = items.long()
+        unit_times = unit_times.long()
+        known = (items >= 0) & (items < self.release_time.size(0)) & (unit_times >= 0) & (unit_times <= self.max_time)
+        items = items.masked_fill(~known, 0)
+        unit_times = unit_times.masked_fill(~known, 0)
+        release_times = self.release_time[items]
+        known = known & (release_times >= 0)
+        release_times = release_times.clamp(min=0, max=self.time_weight.size(0) - 1)
+
+        history_times = (unit_times - 1 - self.time_offset).clamp(min=0, max=self.ema_table.size(1) - 1)
+        pop_history_output = self.ema_table[items.clamp(max=self.ema_table.size(0) - 1), history_times]
+
+        item_embeds = self.item_weight[self._embedding_ids(items, self.item_weight)]
+        time_embeds = self.time_weight[unit_times.clamp(max=self.time_weight.size(0) - 1)]
+        release_time_embeds = self.time_weight[release_times]
+        temporal_gap = release_time_embeds - time_embeds
+        item_temp_embed = torch.cat((temporal_gap, item_embeds, time_embeds, release_time_embeds), 1)
+        time_output = F.relu(F.linear(item_temp_embed, self.fc_time_weight, self.fc_time_bias)).squeeze(1)
+
+        cat_embeds = self.cat_weight[self._embedding_ids(self.cat_encoded[items].clamp(min=0), self.cat_weight)]
+        store_embeds = self.store_weight[self._embedding_ids(self.store_encoded[items].clamp(min=0), self.store_weight)]
+        sideinfo_output = F.relu(F.linear(torch.cat((cat_embeds, store_embeds), 1), self.fc_side_weight, self.fc_side_bias)).squeeze(1)
+
+        conformity = pop_history_output * self.attention[0] + time_output * self.attention[1]
+        quality = sideinfo_output * self.attention[2]
+        nan = torch.full_like(conformity, float('nan'))
+        return torch.where(known, conformity, nan), torch.where(known, quality, nan)
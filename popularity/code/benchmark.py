@@ -0,0 +1,226 @@
+import io
+import time
+import warnings
+import contextlib
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import torch
+from torch.utils.data import DataLoader
+
+from preprocess import expand_items, PopCounts, create_datasets, TensorBatchIterator
+from Model import PopPredict
+from training_utils import train, evaluate
+
+parser = argparse.ArgumentParser()
+parser.add_argument("bench", type=str, choices=['expand', 'counts', 'loader', 'score', 'train'],
+                    help="benchmark to run")
+parser.add_argument("--num_items", type=int, default=100000,
+                    help="number of synthetic items")
+parser.add_argument("--max_time", type=int, default=40,
+                    help="largest unit_time of the synthetic catalog")
+parser.add_argument("--legacy_items", type=int, default=100000,
+                    help="number of items to run through the row-wise reference implementation")
+parser.add_argument("--num_events", type=int, default=5000000,
+                    help="number of synthetic interactions")
+parser.add_argument("--batch_sizes", type=str, default='64,8192',
+                    help="comma separated batch sizes for the loader benchmark")
+
+args = parser.parse_args()
+
+def make_items(num_items, max_time):
+    rng = np.random.default_rng(2024)
+    return pd.DataFrame({
+        'item_encoded': np.arange(1, num_items + 1),
+        'release_time': rng.integers(0, max_time + 1, num_items),
+        'pop_history': [[0] * (max_time + 1)] * num_items,
+        'average_rating': rng.uniform(1, 5, num_items),
+        'cat_encoded': rng.integers(1, 100, num_items),
+        'store_encoded': rng.integers(1, 1000, num_items)
+    })
+
+def legacy_expand_time(row, max_time):
+    unit_times = range(row['release_time'], max_time + 1)
+    return pd.DataFrame({
+        'item_encoded': [row['item_encoded']] * len(unit_times),
+        'unit_time': list(unit_times),
+        'release_time': [row['release_time']] * len(unit_times),
+        'pop_history': [row['pop_history']] * len(unit_times),
+        'average_rating': [row['average_rating']] * len(unit_times),
+        'cat_encoded': [row['cat_encoded']] * len(unit_times),
+        'store_encoded': [row['store_encoded']] * len(unit_times)
+    })
+
+def bench_expand():
+    item_df = make_items(args.num_items, args.max_time)
+
+    start = time.perf_counter()
+    result_df = expand_items(item_df, args.max_time)
+    vectorized_sec = time.perf_counter() - start
+    print(f"expand_items: {args.num_items} items -> {len(result_df)} rows in {vectorized_sec:.3f}s")
+
+    legacy_df = item_df.iloc[:args.legacy_items]
+    start = time.perf_counter()
+    legacy_result = pd.concat([legacy_expand_time(row, args.max_time) for _, row in legacy_df.iterrows()]).reset_index(drop=True)
+    legacy_sec = time.perf_counter() - start
+    legacy_sec_scaled = legacy_sec * args.num_items / len(legacy_df)
+    print(f"row-wise expand_time: {len(legacy_df)} items -> {len(legacy_result)} rows in {legacy_sec:.3f}s")
+
+    pd.testing.assert_frame_equal(legacy_result, result_df.iloc[:len(legacy_result)], check_dtype=False)
+    print(f"speedup: {legacy_sec_scaled / vectorized_sec:.1f}x")
+
+def make_events(num_items, max_time, num_events):
+    rng = np.random.default_rng(2024)
+    # long-tailed catalog: most items see only a handful of interactions
+    items = np.minimum(rng.zipf(1.3, num_events), num_items - 1)
+    unit_times = rng.integers(0, max_time + 1, num_events)
+    return items, unit_times
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def legacy_pop_history(df, max_time):
+    time_range = list(range(0, max_time+1))
+    count_per_group = df.groupby(['item_encoded', 'unit_time']).size().unstack(fill_value=0)
+    count_per_group = count_per_group.reindex(columns=time_range, fill_value=0)
+    return count_per_group.apply(lambda row: row.tolist(), axis=1)
+
+def bench_counts():
+    items, unit_times = make_events(args.num_items, args.max_time, args.num_events)
+    mb = 1024 ** 2
+
+    pop_counts, elapsed, peak = measure(lambda: PopCounts.from_codes(items, unit_times, args.num_items, args.max_time))
+    print(f"PopCounts: {args.num_items} items, {len(pop_counts.items)} non-zero cells, "
+          f"{pop_counts.nbytes / mb:.1f}MB stored, {peak / mb:.1f}MB peak, {elapsed:.2f}s")
+    print(f"dense int32 matrix would take {args.num_items * (args.max_time + 1) * 4 / mb:.1f}MB")
+
+    batch_items = np.random.default_rng(0).integers(0, args.num_items, 8192)
+    _, elapsed, peak = measure(lambda: pop_counts.densify(batch_items))
+    print(f"densify {len(batch_items)} items: {peak / mb:.1f}MB peak, {elapsed * 1000:.1f}ms")
+
+    # the row-wise reference is measured on a slice of the catalog and scaled up
+    mask = items < args.legacy_items
+    df = pd.DataFrame({'item_encoded': items[mask], 'unit_time': unit_times[mask]})
+    active_items = df['item_encoded'].nunique()
+    _, elapsed, peak = measure(lambda: legacy_pop_history(df, args.max_time))
+    active_total = len(np.unique(items))
+    print(f"groupby/unstack pop_history: {active_items} active items, {peak / mb:.1f}MB peak, {elapsed:.2f}s "
+          f"(~{peak * active_total / active_items / mb:.0f}MB for all {active_total} active items)")
+
+def epoch_throughput(data_loader):
+    num_samples = 0
+    start = time.perf_counter()
+    for batch in data_loader:
+        num_samples += len(batch['item'])
+    return num_samples / (time.perf_counter() - start)
+
+def bench_loader():
+    item_df = make_items(args.num_items, args.max_time).drop(columns='pop_history')
+    items, unit_times = make_events(args.num_items + 1, args.max_time, args.num_events)
+    pop_counts = PopCounts.from_codes(items, unit_times, args.num_items + 1, args.max_time)
+    dataset = create_datasets(*[expand_items(item_df, args.max_time)] * 3, pop_counts)[0]
+    print(f"{len(dataset)} rows")
+
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=4)
+        print(f"DataLoader(num_workers=4) batch_size={batch_size}: {epoch_throughput(data_loader):.0f} samples/sec")
+        data_loader = TensorBatchIterator(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+        print(f"TensorBatchIterator batch_size={batch_size}: {epoch_throughput(data_loader):.0f} samples/sec")
+
+def bench_score():
+    item_df = make_items(args.num_items, args.max_time).drop(columns='pop_history')
+    items, unit_times = make_events(args.num_items + 1, args.max_time, args.num_events)
+    pop_counts = PopCounts.from_codes(items, unit_times, args.num_items + 1, args.max_time)
+    config = SimpleNamespace(alpha=0.7, embedding_dim=64)
+    model = PopPredict(config, args.num_items, 100, 1000, args.max_time, pop_counts).eval()
+    result_df = expand_items(item_df, args.max_time)
+    batch_size = int(args.batch_sizes.split(',')[0])
+
+    start = time.perf_counter()
+    data_loader = TensorBatchIterator(create_datasets(result_df, result_df, result_df, pop_counts)[2], batch_size=batch_size)
+    with torch.no_grad():
+        batched = [torch.cat(outputs).squeeze(1) for outputs in zip(*[model(batch)[:3] for batch in data_loader])]
+    batched_sec = time.perf_counter() - start
+    print(f"forward over {len(result_df)} rows at batch_size={batch_size}: {batched_sec:.2f}s")
+
+    columns = {k: torch.tensor(item_df[k].values, dtype=torch.long) for k in ['item_encoded', 'release_time', 'cat_encoded', 'store_encoded']}
+    times = torch.arange(args.max_time + 1)
+    start = time.perf_counter()
+    with torch.no_grad():
+        dense = model.score_dense(columns['item_encoded'], columns['release_time'], columns['cat_encoded'], columns['store_encoded'], times)
+        valid = times.unsqueeze(0) >= columns['release_time'].unsqueeze(1)
+        dense = [output[valid] for output in dense]
+    dense_sec = time.perf_counter() - start
+    print(f"score_dense over {args.num_items} items x {args.max_time + 1} times: {dense_sec:.2f}s")
+
+    error = max((a - b).abs().max().item() for a, b in zip(batched, dense))
+    print(f"max abs difference: {error:.2e}, speedup: {batched_sec / dense_sec:.1f}x")
+
+def legacy_train(config, model, data_loader, optimizer, device):
+    # training step as it was before the CPU mode: fp16 scaler and autocast,
+    # empty_cache and a host sync on the loss after every batch
+    model.train()
+    total_loss = 0
+    criteria = torch.nn.MSELoss()
+    scaler = torch.cuda.amp.GradScaler()
+    for batch in data_loader:
+        batch = {k: v.to(device) for k, v in batch.items()}
+        optimizer.zero_grad()
+        with torch.cuda.amp.autocast():
+            pop_history_output, time_output, sideinfo_output, output = model(batch)
+            pop_gt = batch['pop_gt'].float()
+            scaled_avg_rating = batch['average_rating'] * (pop_gt / 5.0)
+            loss = (config.wt_pop * criteria(pop_history_output.squeeze(), pop_gt) + config.wt_time * criteria(time_output.squeeze(), pop_gt)
+                    + config.wt_side * criteria(sideinfo_output.squeeze(), scaled_avg_rating) + criteria(output.squeeze(), pop_gt))
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        total_loss += loss.item()
+        torch.cuda.empty_cache()
+    return total_loss / len(data_loader)
+
+def bench_train():
+    warnings.filterwarnings('ignore')
+    item_df = make_items(args.num_items, args.max_time).drop(columns='pop_history')
+    items, unit_times = make_events(args.num_items + 1, args.max_time, args.num_events)
+    pop_counts = PopCounts.from_codes(items, unit_times, args.num_items + 1, args.max_time)
+    dataset = create_datasets(*[expand_items(item_df, args.max_time)] * 3, pop_counts)[0]
+    device = torch.device('cpu')
+    print(f"{len(dataset)} rows, {torch.get_num_threads()} threads")
+
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        for name, train_fn, bf16 in [('legacy', legacy_train, False), ('cpu fp32', train, False), ('cpu bf16', train, True)]:
+            config = SimpleNamespace(alpha=0.7, embedding_dim=64, wt_pop=0.1, wt_time=1, wt_side=1, bf16=bf16)
+            torch.manual_seed(2024)
+            model = PopPredict(config, args.num_items, 100, 1000, args.max_time, pop_counts)
+            optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+            data_loader = TensorBatchIterator(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                loss = train_fn(config, model, data_loader, optimizer, device)
+            elapsed = time.perf_counter() - start
+            valid_loss, valid_rmse = evaluate(config, model, TensorBatchIterator(dataset, batch_size=8192), device)
+            print(f"{name} batch_size={batch_size}: {len(data_loader) * batch_size / elapsed:.0f} samples/sec, "
+                  f"train loss {loss:.4f}, full-set loss {valid_loss:.4f}, rmse {valid_rmse:.4f}")
+
+if __name__ == "__main__":
+    if args.bench == 'expand':
+        bench_expand()
+    elif args.bench == 'counts':
+        bench_counts()
+    elif args.bench == 'loader':
+        bench_loader()
+    elif args.bench == 'score':
+        bench_score()
+    elif args.bench == 'train':
+        bench_train()
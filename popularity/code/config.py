@@ -10,6 +10,14 @@ class Config(object):
         self.lr = args.lr 
         self.time_unit = args.time_unit 
         self.pop_time_unit = args.pop_time_unit 
+        self.bucket_time = args.bucket_time
+        self.rollup_units = [int(unit) for unit in args.rollup_units.split(',') if unit]
+        self.sequence_batch = args.sequence_batch
+        self.grid_workers = args.grid_workers
+        self.halving_factor = args.halving_factor
+        self.halving_min_epochs = args.halving_min_epochs
+        self.device = args.device
+        self.bf16 = args.bf16
         self.dataset = args.dataset
         self.data_preprocessed = args.data_preprocessed
         self.test_only = args.test_only
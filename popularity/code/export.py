@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import numpy as np
+import torch
+
+from storage import load_pop_store, dataset_sources, PreprocessCache
+from Model import PopPredict, PopScorer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset", type=str, default='14_Sports',
+                    help="dataset file name")
+parser.add_argument("--alpha", type=float, default=0.7,
+                    help="parameter for balance of pop_history and time")
+parser.add_argument("--embedding_dim", type=int, default=64,
+                    help="embedding size, replaced by the checkpoint's")
+parser.add_argument("--time_unit", type=int, default=1000*60*60*24,
+                    help="smallest time unit for model training(default: day)")
+parser.add_argument("--pop_time_unit", type=int, default=30*3,
+                    help="smallest time unit for item popularity statistic")
+parser.add_argument("--bucket_time", action="store_true",
+                    help="export with the store built from bucketed review timestamps")
+parser.add_argument("--output", type=str, default=None,
+                    help="artifact path (default: ../../model/pop/<dataset>/pop_scorer.pt)")
+parser.add_argument("--batch_size", type=int, default=4096,
+                    help="pairs per batch for the latency check in a fresh process")
+parser.add_argument("--iters", type=int, default=100,
+                    help="batches timed by the latency check (0: skip it)")
+
+args = parser.parse_args()
+
+def check_scorer(scorer, model, item_columns, max_time, num_pairs=10000):
+    """
+    Largest absolute difference between the scripted scorer and PopPredict.forward
+    on random (item, unit_time) pairs of the store.
+    """
+    rng = np.random.default_rng(2024)
+    positions = rng.integers(0, len(item_columns['item_encoded']), num_pairs)
+    batch = {
+        'item': torch.as_tensor(np.asarray(item_columns['item_encoded'])[positions], dtype=torch.long),
+        'time': torch.as_tensor(rng.integers(0, max_time + 1, num_pairs), dtype=torch.long),
+        'release_time': torch.as_tensor(np.asarray(item_columns['release_time'])[positions], dtype=torch.long),
+        'category': torch.as_tensor(np.asarray(item_columns['cat_encoded'])[positions], dtype=torch.long),
+        'store': torch.as_tensor(np.asarray(item_columns['store_encoded'])[positions], dtype=torch.long)
+    }
+    with torch.no_grad():
+        pop_history_output, time_output, sideinfo_output, _ = model(batch)
+        conformity, quality = scorer(batch['item'], batch['time'])
+    return max((conformity - (pop_history_output + time_output).squeeze(1)).abs().max().item(),
+               (quality - sideinfo_output.squeeze(1)).abs().max().item())
+
+def main():
+    processed_path = f'../../dataset/{args.dataset}/preprocessed/'
+    store_path = PreprocessCache(processed_path, dataset_sources(args.dataset), args).lookup()
+    if store_path is None:
+        raise FileNotFoundError(f"No preprocessed popularity store for {args.dataset} in {processed_path}, run main.py first")
+    checkpoint_path = f'../../model/pop/{args.dataset}/best_model.pt'
+    if not os.path.exists(checkpoint_path):
+        raise FileNotFoundError(f"Checkpoint {checkpoint_path} not found")
+    output_path = args.output or f'../../model/pop/{args.dataset}/pop_scorer.pt'
+
+    item_columns, pop_counts, meta = load_pop_store(store_path)
+    model = PopPredict.from_checkpoint(checkpoint_path, args, pop_counts).eval()
+    scorer = PopScorer(model, item_columns, meta['max_time']).eval()
+    num_items = scorer.release_time.size(0)
+    # freezing folds the baked tables into constants of the graph
+    scorer = torch.jit.freeze(torch.jit.script(scorer), preserved_attrs=['known_items'])
+    print(f"max abs difference to PopPredict.forward: {check_scorer(scorer, model, item_columns, meta['max_time']):.2e}")
+
+    scorer_meta = {
+        'dataset': args.dataset,
+        'max_time': int(meta['max_time']),
+        'num_items': int(num_items),
+        'alpha': model.module_pop_history.alpha,
+        'embedding_dim': model.embedding_dim,
+        'history_revision': meta.get('history_revision', 0)
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    torch.jit.save(scorer, output_path, _extra_files={'meta.json': json.dumps(scorer_meta)})
+    print(f"Exported scorer to {output_path} ({os.path.getsize(output_path) / 1024 ** 2:.1f}MB)")
+
+    if args.iters > 0:
+        # load in a fresh interpreter that imports nothing from this repo
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_scorer.py'), output_path,
+                        '--batch_size', str(args.batch_size), '--iters', str(args.iters)], check=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import os
+import argparse
+from datetime import datetime
+
+from preprocess import load_dataset
+from storage import ingest_events, dataset_sources, PreprocessCache
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset", type=str, default='14_Sports',
+                    help="dataset file name")
+parser.add_argument("--events", type=str, required=True,
+                    help="pickled DataFrame of new interactions (item_encoded, unit_time, average_rating, cat_encoded, store_encoded)")
+parser.add_argument("--time_unit", type=int, default=1000*60*60*24,
+                    help="smallest time unit for model training(default: day)")
+parser.add_argument("--pop_time_unit", type=int, default=30*3,
+                    help="smallest time unit for item popularity statistic")
+parser.add_argument("--bucket_time", action="store_true",
+                    help="ingest into the store built from bucketed review timestamps")
+
+args = parser.parse_args()
+
+def main():
+    processed_path = f'../../dataset/{args.dataset}/preprocessed/'
+    cache = PreprocessCache(processed_path, dataset_sources(args.dataset), args)
+    key, store_path = cache.latest()
+    if store_path is None:
+        raise FileNotFoundError(f"No preprocessed popularity store for {args.dataset} in {processed_path}, run main.py first")
+
+    events_df = load_dataset(args.events)
+    meta = ingest_events(store_path, events_df)
+    if len(events_df) == 0:
+        # nothing changed, the store keeps its key and the other stores stay valid
+        return
+    cache.adopt(key, {
+        'events': os.path.abspath(args.events),
+        'num_events': len(events_df),
+        'max_time': meta['max_time'],
+        'time': datetime.now().isoformat(timespec='seconds')
+    })
+    print(f"Store {cache.store_path} now covers unit_time 0..{meta['max_time']} for {meta['num_items']} items")
+
+if __name__ == "__main__":
+    main()
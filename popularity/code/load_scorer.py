@@ -0,0 +1,52 @@
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+# Needs only torch: the scorer written by export.py carries its own tables
+parser = argparse.ArgumentParser()
+parser.add_argument("scorer_path", type=str,
+                    help="artifact written by export.py")
+parser.add_argument("--batch_size", type=int, default=4096,
+                    help="(item, unit_time) pairs per batch")
+parser.add_argument("--iters", type=int, default=100,
+                    help="number of timed batches")
+parser.add_argument("--threads", type=int, default=0,
+                    help="torch intra-op threads (0: torch default)")
+
+args = parser.parse_args()
+
+def load_scorer(scorer_path, device='cpu'):
+    extra_files = {'meta.json': ''}
+    scorer = torch.jit.load(scorer_path, map_location=device, _extra_files=extra_files)
+    return scorer, json.loads(extra_files['meta.json'])
+
+def main():
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    start = time.perf_counter()
+    scorer, meta = load_scorer(args.scorer_path)
+    load_sec = time.perf_counter() - start
+    print(f"loaded {meta['dataset']} scorer ({meta['num_items']} items, unit_time 0..{meta['max_time']}) in {load_sec * 1000:.1f}ms")
+
+    rng = np.random.default_rng(2024)
+    known_items = scorer.known_items().numpy()
+    batches = [(torch.from_numpy(rng.choice(known_items, args.batch_size)),
+                torch.from_numpy(rng.integers(0, meta['max_time'] + 1, args.batch_size))) for _ in range(args.iters + 10)]
+
+    latencies = []
+    with torch.no_grad():
+        for i, (items, unit_times) in enumerate(batches):
+            start = time.perf_counter()
+            conformity, quality = scorer(items, unit_times)
+            # the first batches run the profiling passes of the TorchScript executor
+            if i >= 10:
+                latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    print(f"batch_size={args.batch_size}: p50 {np.percentile(latencies, 50):.3f}ms, p99 {np.percentile(latencies, 99):.3f}ms, "
+          f"{args.batch_size / np.percentile(latencies, 50) * 1000:.0f} pairs/sec")
+
+if __name__ == "__main__":
+    main()
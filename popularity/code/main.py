@@ -2,24 +2,27 @@ import random
 import pickle
 import logging
 import os
-import gc  
+import gc
+import copy
+import time
+import multiprocessing as mp  
 from datetime import datetime
 import pandas as pd
+import numpy as np
 import argparse
 from tqdm import tqdm
-import itertools
 
 import torch
 import torch.nn as nn
 from torch.optim import Adam
-from torch.utils.data import DataLoader
 from torch.optim.lr_scheduler import StepLR
 import torch.distributed as dist
 
 from config import Config
-from preprocess import load_dataset, preprocess_df, create_datasets
-from Model import PopPredict
-from training_utils import train, evaluate, test, EarlyStopping
+from preprocess import load_dataset, preprocess_df, split_df, create_datasets, bucket_times, build_rollups, TensorBatchIterator, ItemSequenceDataset
+from storage import save_pop_store, load_pop_store, dataset_sources, PreprocessCache
+from Model import PopPredict, generate_outputs
+from training_utils import train, train_sequence, evaluate, test, EarlyStopping, SuccessiveHalving, run_grid
 
 ########################################################### config
 random.seed(2024)
@@ -40,10 +43,26 @@ parser.add_argument("--time_unit", type=int, default=1000*60*60*24,
                     help="smallest time unit for model training(default: day)")
 parser.add_argument("--pop_time_unit", type=int, default=30*3,
                     help="smallest time unit for item popularity statistic")
+parser.add_argument("--bucket_time", action="store_true",
+                    help="bucket raw review timestamps by time_unit and roll them up to pop_time_unit instead of using the dataset's unit_time")
+parser.add_argument("--rollup_units", type=str, default='30,90',
+                    help="comma separated pop_time_unit values precomputed from the finest buckets when --bucket_time is set")
+parser.add_argument("--sequence_batch", action="store_true",
+                    help="train on one row per item scored at every unit_time (batch_size then counts items)")
+parser.add_argument("--grid_workers", type=int, default=0,
+                    help="parallel hyperparameter trials on CPU (0: one per core, 1: sequential)")
+parser.add_argument("--halving_factor", type=int, default=3,
+                    help="successive halving keeps the best 1/halving_factor of grid trials at each milestone (0: no pruning)")
+parser.add_argument("--halving_min_epochs", type=int, default=2,
+                    help="first successive halving milestone, later ones grow by halving_factor")
+parser.add_argument("--device", type=str, default='auto', choices=['auto', 'cpu', 'cuda'],
+                    help="device for training and scoring (auto: cuda when available)")
+parser.add_argument("--bf16", action="store_true",
+                    help="bf16 autocast instead of fp32 on CPU or fp16 on CUDA")
 parser.add_argument("--dataset", type=str, default='14_Sports',
                     help="dataset file name")
 parser.add_argument("--data_preprocessed", action="store_true",
-                    help="flag to indicate if the input data has already been preprocessed")
+                    help="unused: preprocessed data is reused automatically when the cache manifest matches")
 parser.add_argument("--test_only", action="store_true",
                     help="flag to indicate if only testing should be performed")
 parser.add_argument("--embedding_dim", type=int, default=64,
@@ -79,200 +98,201 @@ def load_data(dataset_name):
     sampled_file_path = f'{dataset_path}{dataset_name}.pkl'      
     processed_path = f'{dataset_path}preprocessed/'
 
-    combined_df = None  
-
-    if os.path.exists(f'{processed_path}/train_df_pop.pkl') and os.path.exists(f'{processed_path}/valid_df_pop.pkl') and os.path.exists(f'{processed_path}/test_df_pop.pkl') and config.data_preprocessed:
-        with open(f'{processed_path}/train_df_pop.pkl', 'rb') as file:
-            train_df = pickle.load(file)
-        with open(f'{processed_path}/valid_df_pop.pkl', 'rb') as file:
-            valid_df = pickle.load(file)
-        with open(f'{processed_path}/test_df_pop.pkl', 'rb') as file:
-            test_df = pickle.load(file)
-
-        combined_df = pd.concat([train_df, valid_df, test_df])
-        num_items = combined_df['item_encoded'].max() + 1
-        num_cats = combined_df['cat_encoded'].max() + 1
-        num_stores = combined_df['store_encoded'].max() + 1
-        max_time = combined_df["unit_time"].max()
+    cache = PreprocessCache(processed_path, dataset_sources(dataset_name), config)
+    store_path = cache.lookup()
+    if store_path is not None:
+        item_columns, pop_counts, meta = load_pop_store(store_path)
         print("Processed files already exist. Skipping dataset preparation.")
     else:
-        try:
-            if config.dataset[:8] == 'sampled_':
-                review_file_path = f'../../dataset/{dataset_name[8:]}/{dataset_name[8:]}.pkl'
-                df = load_dataset(review_file_path)
-                sampled_df = load_dataset(sampled_file_path)
-                sampled_items = sampled_df['item_encoded'].unique()
-                filtered_df = df[df['item_encoded'].isin(sampled_items)]
-            else:
-                filtered_df = load_dataset(sampled_file_path)
-
-            num_items = filtered_df['item_encoded'].max() + 1
-            num_cats = filtered_df['cat_encoded'].max() + 1
-            num_stores = filtered_df['store_encoded'].max() + 1
-
-            train_df, valid_df, test_df, max_time = preprocess_df(filtered_df, config)
-            combined_df = pd.concat([train_df, valid_df, test_df])
-            if not os.path.exists(processed_path):
-                os.makedirs(processed_path)
-            date_str = datetime.now().strftime('%y%m%d%H%M')
-            train_df.to_pickle(f'{processed_path}/train_df_pop_{date_str}.pkl')
-            valid_df.to_pickle(f'{processed_path}/valid_df_pop_{date_str}.pkl')
-            test_df.to_pickle(f'{processed_path}/test_df_pop_{date_str}.pkl')
-
-        except Exception as e:
-            raise
+        # With bucket_time the finest buckets are cached on their own and every
+        # pop_time_unit is rolled up from them without re-reading the reviews
+        base_cache = cache.derive(pop_time_unit=1) if config.bucket_time else cache
+        base_path = base_cache.lookup()
+        if base_path is not None:
+            item_columns, pop_counts, meta = load_pop_store(base_path)
+        else:
+            try:
+                if config.dataset[:8] == 'sampled_':
+                    review_file_path = f'../../dataset/{dataset_name[8:]}/{dataset_name[8:]}.pkl'
+                    df = load_dataset(review_file_path)
+                    sampled_df = load_dataset(sampled_file_path)
+                    sampled_items = sampled_df['item_encoded'].unique()
+                    filtered_df = df[df['item_encoded'].isin(sampled_items)]
+                else:
+                    filtered_df = load_dataset(sampled_file_path)
+
+                if config.bucket_time:
+                    filtered_df = filtered_df.assign(unit_time=bucket_times(filtered_df['timestamp'], config.time_unit))
+                item_columns, pop_counts, max_time = preprocess_df(filtered_df, config)
+                meta = save_pop_store(base_cache.store_path, item_columns, pop_counts, max_time)
+                base_cache.record()
+
+            except Exception as e:
+                raise
+
+        if config.bucket_time:
+            rollups = build_rollups(item_columns, pop_counts, config.rollup_units + [config.pop_time_unit])
+            for factor, (rollup_items, rollup_counts) in rollups.items():
+                rollup_cache = cache.derive(pop_time_unit=factor)
+                if factor != 1 and rollup_cache.lookup() is None:
+                    save_pop_store(rollup_cache.store_path, rollup_items, rollup_counts, rollup_counts.max_time)
+                    rollup_cache.record()
+            item_columns, pop_counts, meta = load_pop_store(cache.store_path)
 
     if 'df' in locals():
         del df
     gc.collect()
 
-    return train_df, valid_df, test_df, combined_df, num_items, num_cats, num_stores, max_time
+    num_items, num_cats, num_stores, max_time = meta['num_items'], meta['num_cats'], meta['num_stores'], meta['max_time']
+    train_df, valid_df, test_df = split_df(item_columns, max_time)
+
+    return item_columns, train_df, valid_df, test_df, pop_counts, num_items, num_cats, num_stores, max_time, meta.get('history_revision', 0)
+
+# Filled in by main() before the grid starts; forked trial workers inherit it read-only
+trial_data = {}
+
+def run_trial(params):
+    """
+    Train one grid point with loaders sized to its own batch_size and return its
+    scores and the state of its best epoch on the validation set.
+    """
+    trial_config = copy.copy(config)
+    trial_config.lr = params['lr']
+    trial_config.batch_size = params['batch_size']
+    trial_config.embedding_dim = params['embedding_dim']
+    device = trial_data['device']
+    print(f"Training with lr={trial_config.lr}, batch_size={trial_config.batch_size}, embedding_dim={trial_config.embedding_dim}")
+
+    train_loader = TensorBatchIterator(trial_data['train_dataset'], batch_size=trial_config.batch_size, shuffle=True, drop_last=True, device=device)
+    valid_loader = TensorBatchIterator(trial_data['valid_dataset'], batch_size=trial_config.batch_size, device=device)
+    test_loader = TensorBatchIterator(trial_data['test_dataset'], batch_size=trial_config.batch_size, device=device)
+
+    model = PopPredict(trial_config, *trial_data['sizes'], trial_data['pop_counts']).to(device)
+    optimizer = Adam(model.parameters(), lr=trial_config.lr, weight_decay=0.0001)
+    scheduler = StepLR(optimizer, step_size=10, gamma=0.1)
+    early_stopping = EarlyStopping(patience=10, verbose=True)
+    result = dict(params, epoch=None, valid_loss=float('inf'), epochs_run=0, pruned=False, state_dict=None)
+
+    start_time = time.perf_counter()
+    for epoch in range(trial_config.num_epochs):
+        train_loss = trial_data['train_fn'](trial_config, model, train_loader, optimizer, device)
+        valid_loss, valid_rmse = evaluate(trial_config, model, valid_loader, device)
+        scheduler.step()
+
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
 
-def load_model_state(model, checkpoint_path, device):
-    checkpoint = torch.load(checkpoint_path, map_location=device)
-    embedding_dim = checkpoint['embedding_dim']
-    
-    model.item_embedding = nn.Embedding(model.item_embedding.num_embeddings, embedding_dim).to(device)
-    model.cat_embedding = nn.Embedding(model.cat_embedding.num_embeddings, embedding_dim).to(device)
-    model.store_embedding = nn.Embedding(model.store_embedding.num_embeddings, embedding_dim).to(device)
-    model.time_embedding = nn.Embedding(model.time_embedding.num_embeddings, embedding_dim).to(device)
-        
-    model.module_time.fc_time_value = nn.Linear(4 * embedding_dim, 1).to(device)
-    model.module_sideinfo.fc_output = nn.Linear(2 * embedding_dim, 1).to(device)
-
-    new_state_dict = {}
-    for k, v in checkpoint['model_state_dict'].items():
-        if k.startswith('module.'):
-            new_state_dict[k[7:]] = v  # remove 'module.' prefix
-        else:
-            new_state_dict[k] = v
-    model.load_state_dict(new_state_dict)
-    model.to(device)
-
-def generate_outputs(model, data_loader, device):
-    model.eval()
-    all_outputs = []
-
-    with torch.no_grad():
-        for batch in tqdm(data_loader, desc="Generating Outputs"):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            weighted_pop_history_output, weighted_time_output, weighted_sideinfo_output, output = model(batch)
-            for i in range(len(batch['item'])):
-                all_outputs.append({
-                    'weighted_pop_history_output': weighted_pop_history_output[i].cpu().numpy(),
-                    'weighted_time_output': weighted_time_output[i].cpu().numpy(),
-                    'weighted_sideinfo_output': weighted_sideinfo_output[i].cpu().numpy()
-                })
-
-    return all_outputs
+        logging.info(f'Epoch {epoch+1}, Train Loss: {train_loss:.4f}, Valid Loss: {valid_loss:.4f}, Valid RMSE: {valid_rmse:.4f}_with {params}')
+
+        if valid_loss < result['valid_loss']:
+            result.update(epoch=epoch, valid_loss=valid_loss, valid_rmse=valid_rmse,
+                          state_dict={k: v.detach().cpu().clone() for k, v in model.state_dict().items()})
+
+        result['epochs_run'] = epoch + 1
+        early_stopping(valid_loss)
+        if early_stopping.early_stop:
+            print("Early stopping triggered.")
+            break
+        if trial_data['halving'](epoch + 1, valid_loss):
+            result['pruned'] = True
+            print(f"Pruned by successive halving after epoch {epoch+1}.")
+            logging.info(f'Pruned by successive halving after epoch {epoch+1}_with {params}')
+            break
+
+    test_loss, test_rmse = test(trial_config, model, test_loader, device)
+    result.update(test_loss=test_loss, test_rmse=test_rmse, seconds=round(time.perf_counter() - start_time, 1))
+    logging.info(f'Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}_with lr={trial_config.lr}, batch_size={trial_config.batch_size}, embedding_dim={trial_config.embedding_dim}')
+    print(f"Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}_with lr={trial_config.lr}, batch_size={trial_config.batch_size}, embedding_dim={trial_config.embedding_dim}")
+    return result
 
 def main():
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
     os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
     setup_logging(config.dataset)
 
-    best_loss = float('inf')
-    best_model_params = {}
-    model_save_path = None
-
-    train_df, valid_df, test_df, combined_df, num_items, num_cats, num_stores, max_time = load_data(config.dataset)
+    item_columns, train_df, valid_df, test_df, pop_counts, num_items, num_cats, num_stores, max_time, history_revision = load_data(config.dataset)
     gc.collect()
     
-    train_dataset, valid_dataset, test_dataset = create_datasets(train_df, valid_df, test_df)
+    train_dataset, valid_dataset, test_dataset = create_datasets(train_df, valid_df, test_df, pop_counts)
+    if config.sequence_batch:
+        train_dataset = ItemSequenceDataset(item_columns, pop_counts, max_time - 2)
+        train_fn = train_sequence
+    else:
+        train_fn = train
     del train_df, valid_df, test_df
     gc.collect()
 
-    train_loader = DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True, drop_last=True, num_workers=4, pin_memory=True)
-    valid_loader = DataLoader(valid_dataset, batch_size=config.batch_size, num_workers=4, pin_memory=True)
-    test_loader = DataLoader(test_dataset, batch_size=config.batch_size, num_workers=4, pin_memory=True)
+    if config.device == 'auto':
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(config.device)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    
-    lr_values = [0.001, 0.01]  # Learning rates to try
-    batch_size_values = [32, 64]  # Batch sizes to try
-    embedding_dim_values = [64, 128]  # Embedding dimensions to try
+    trial_data.update({
+        'train_dataset': train_dataset, 'valid_dataset': valid_dataset, 'test_dataset': test_dataset,
+        'train_fn': train_fn, 'pop_counts': pop_counts, 'device': device,
+        'sizes': (num_items, num_cats, num_stores, max_time)
+    })
+
+    param_grid = {
+        'lr': [0.001, 0.01],  # Learning rates to try
+        'batch_size': [32, 64],  # Batch sizes to try
+        'embedding_dim': [64, 128]  # Embedding dimensions to try
+    }
 
     # # Toys_and_Games
     # lr: 0.001, batch_size: 16, embedding_dim: 64
     # Sports_and_Outdoors
     # Best Model Parameters: {'lr': 0.0001, 'batch_size': 16, 'embedding_dim': 128, 'epoch': 0}
 
-    best_loss = float('inf')
-    best_model_params = {}
-    best_model = None
-
-    for lr, batch_size, embedding_dim in itertools.product(lr_values, batch_size_values, embedding_dim_values): 
-        print(f"Training with lr={lr}, batch_size={batch_size}, embedding_dim={embedding_dim}")
-        
-        config.lr = lr
-        config.batch_size = batch_size
-        config.embedding_dim = embedding_dim
-        
-        model = PopPredict(config, num_items, num_cats, num_stores, max_time).to(device)
-        optimizer = Adam(model.parameters(), lr=config.lr, weight_decay=0.0001)
-        scheduler = StepLR(optimizer, step_size=10, gamma=0.1)
-        early_stopping = EarlyStopping(patience=10, verbose=True)
-        
-        for epoch in range(config.num_epochs):
-            train_loss = train(config, model, train_loader, optimizer, device)
-            valid_loss, valid_rmse = evaluate(config, model, valid_loader, device)
-            scheduler.step() 
-
-            torch.cuda.empty_cache()
-            
-            logging.info(f'Epoch {epoch+1}, Train Loss: {train_loss:.4f}, Valid Loss: {valid_loss:.4f}, Valid RMSE: {valid_rmse:.4f}')
-
-            if valid_loss < best_loss:
-                logging.info(f'Best model is changed in epoch {epoch+1}')
-                best_loss = valid_loss
-                best_model_params = {'lr': config.lr, 'batch_size': config.batch_size, 'embedding_dim': config.embedding_dim, 'epoch': epoch}
-                best_model = model.state_dict()
-            
-            early_stopping(valid_loss)
-            if early_stopping.early_stop:
-                print("Early stopping triggered.")
-                break
-
-        test_loss, test_rmse = test(config, model, test_loader, device)
-        logging.info(f'Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}_with lr={lr}, batch_size={batch_size}, embedding_dim={embedding_dim}')
-        print(f"Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}_with lr={lr}, batch_size={batch_size}, embedding_dim={embedding_dim}")
-
-    if best_model is not None:
-        print(f"Best Model Parameters: {best_model_params}")
-        config.embedding_dim = best_model_params['embedding_dim']
-        model = PopPredict(config, num_items, num_cats, num_stores, max_time).to(device)
-        model.load_state_dict(best_model)
-        model_save_path = f'../../model/pop/{config.dataset}/best_model.pt'
-        if not os.path.exists(os.path.dirname(model_save_path)):
-            os.makedirs(os.path.dirname(model_save_path))
-        torch.save({
-            'model_state_dict': model.state_dict(),
-            'embedding_dim': best_model_params['embedding_dim'],  # Save the best embedding dimension
-            'lr': best_model_params['lr'],
-            'batch_size': best_model_params['batch_size']
-        }, model_save_path)
-        
-        test_loss, test_rmse = test(config, model, test_loader, device)
-        logging.info(f'Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}')
-        print(f"Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}")
-
-    pred_dataset = create_datasets(combined_df, combined_df, combined_df)[2]
-    pred_loader = DataLoader(pred_dataset, batch_size=config.batch_size, shuffle=False)
-
-    outputs = generate_outputs(model, pred_loader, device)
-    outputs_df = pd.DataFrame(outputs)
-
-    results_df = pd.concat([combined_df.reset_index(drop=True), outputs_df], axis=1)
-
-    results_df['time_output'] = results_df['weighted_time_output'].apply(lambda x: x[0])
-    results_df['conformity'] = results_df['weighted_pop_history_output'].apply(lambda x: x[0]) + results_df['weighted_time_output'].apply(lambda x: x[0])
-    results_df['quality'] = results_df['weighted_sideinfo_output'].apply(lambda x: x[0])
-    results_df = results_df[['item_encoded', 'unit_time', 'time_output', 'conformity', 'quality']]
-
-    result_path = f'../../dataset/{config.dataset}/pop_{config.dataset}.pkl'
-    os.makedirs(os.path.dirname(result_path), exist_ok=True)
-    results_df.to_pickle(result_path)
-    print(f"Results saved to {result_path}")
+    # CUDA cannot be shared with forked workers, so GPU sweeps run one trial at a time
+    num_workers = 1 if device.type == 'cuda' else config.grid_workers
+    manager = mp.Manager() if num_workers != 1 else None
+    trial_data['halving'] = SuccessiveHalving(config.num_epochs, config.halving_factor, config.halving_min_epochs, manager=manager)
+    results = run_grid(run_trial, param_grid, num_workers=num_workers)
+    if manager is not None:
+        manager.shutdown()
+
+    pruned = [result for result in results if result['pruned']]
+    epochs_saved = sum(config.num_epochs - result['epochs_run'] for result in pruned)
+    print(f"Successive halving pruned {len(pruned)} of {len(results)} trials, saving up to {epochs_saved} of {config.num_epochs * len(results)} epochs")
+    logging.info(f"Successive halving pruned {len(pruned)} of {len(results)} trials, saving up to {epochs_saved} of {config.num_epochs * len(results)} epochs")
+
+    results_df = pd.DataFrame([{k: v for k, v in result.items() if k != 'state_dict'} for result in results])
+    print(results_df.to_string(index=False))
+    results_path = os.path.abspath(f'../../pop_log/{config.dataset}/grid_{datetime.now().strftime("%Y-%m-%d_%H%M%S")}.csv')
+    results_df.to_csv(results_path, index=False)
+    print(f"Grid results saved to {results_path}")
+
+    # A trial keeps no state_dict when its validation loss was never finite (NaN loss or --num_epochs 0)
+    trained = [result for result in results if result['state_dict'] is not None]
+    if not trained:
+        print("No grid trial reached a finite validation loss, skipping the checkpoint and outputs")
+        logging.warning("No grid trial reached a finite validation loss, skipping the checkpoint and outputs")
+        return
+    best_result = min(trained, key=lambda result: result['valid_loss'])
+    best_model_params = {k: best_result[k] for k in ['lr', 'batch_size', 'embedding_dim', 'epoch']}
+    print(f"Best Model Parameters: {best_model_params}")
+    config.embedding_dim = best_model_params['embedding_dim']
+    model = PopPredict(config, num_items, num_cats, num_stores, max_time, pop_counts).to(device)
+    model.load_state_dict(best_result['state_dict'])
+    model_save_path = f'../../model/pop/{config.dataset}/best_model.pt'
+    if not os.path.exists(os.path.dirname(model_save_path)):
+        os.makedirs(os.path.dirname(model_save_path))
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'embedding_dim': best_model_params['embedding_dim'],  # Save the best embedding dimension
+        'lr': best_model_params['lr'],
+        'batch_size': best_model_params['batch_size']
+    }, model_save_path)
+
+    test_loader = TensorBatchIterator(test_dataset, batch_size=best_model_params['batch_size'], device=device)
+    test_loss, test_rmse = test(config, model, test_loader, device)
+    logging.info(f'Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}')
+    print(f"Test Loss: {test_loss:.4f}, Test RMSE: {test_rmse:.4f}")
+
+    result_path = f'../../dataset/{config.dataset}/pop_{config.dataset}/'
+    meta = generate_outputs(model, item_columns, max_time, device, result_path, history_revision)
+    print(f"Results saved to {result_path} ({meta['columns']['unit_time']['length']} rows)")
 
 if __name__ == "__main__":
     main()
@@ -6,14 +6,14 @@ import gc
 from tqdm.auto import tqdm
 from datetime import datetime
 import pandas as pd
+import numpy as np
 import argparse
 
 import torch
-from torch.utils.data import DataLoader
 
 from config import Config
-from preprocess import create_datasets
-from Model import PopPredict
+from storage import load_pop_store, dataset_sources, PreprocessCache, write_column, write_column_tail, write_meta, open_columns, write_handoff, append_handoff, read_handoff_header, PREDICTION_COLUMNS, HANDOFF_FILE
+from Model import PopPredict, score_chunks, generate_outputs
 
 ########################################################### config
 random.seed(2024)
@@ -34,10 +34,28 @@ parser.add_argument("--time_unit", type=int, default=1000*60*60*24,
                     help="smallest time unit for model training")
 parser.add_argument("--pop_time_unit", type=int, default=3*30,
                     help="smallest time unit for item popularity statistic")
+parser.add_argument("--bucket_time", action="store_true",
+                    help="bucket raw review timestamps by time_unit and roll them up to pop_time_unit instead of using the dataset's unit_time")
+parser.add_argument("--rollup_units", type=str, default='30,90',
+                    help="comma separated pop_time_unit values precomputed from the finest buckets when --bucket_time is set")
+parser.add_argument("--sequence_batch", action="store_true",
+                    help="train on one row per item scored at every unit_time (batch_size then counts items)")
+parser.add_argument("--grid_workers", type=int, default=0,
+                    help="parallel hyperparameter trials on CPU (0: one per core, 1: sequential)")
+parser.add_argument("--halving_factor", type=int, default=3,
+                    help="successive halving keeps the best 1/halving_factor of grid trials at each milestone (0: no pruning)")
+parser.add_argument("--halving_min_epochs", type=int, default=2,
+                    help="first successive halving milestone, later ones grow by halving_factor")
+parser.add_argument("--device", type=str, default='auto', choices=['auto', 'cpu', 'cuda'],
+                    help="device for training and scoring (auto: cuda when available)")
+parser.add_argument("--bf16", action="store_true",
+                    help="bf16 autocast instead of fp32 on CPU or fp16 on CUDA")
+parser.add_argument("--refresh", action="store_true",
+                    help="only score unit_times and items added since the last run and append them to the existing predictions")
 parser.add_argument("--dataset", type=str, default='Home_and_Kitchen',
                     help="dataset file name")
 parser.add_argument("--data_preprocessed", action="store_true",
-                    help="flag to indicate if the input data has already been preprocessed")
+                    help="unused: preprocessed data is reused automatically when the cache manifest matches")
 parser.add_argument("--test_only", action="store_true",
                     help="flag to indicate if only testing should be performed")
 parser.add_argument("--embedding_dim", type=int, default=128,
@@ -52,126 +70,99 @@ parser.add_argument("--wt_side", type=float, default=2.0,
 args = parser.parse_args()
 config = Config(args=args)
 
-def expand_time(row, max_time):
-    unit_times = range(row['release_time'], max_time + 1)
-    return pd.DataFrame({
-        'item_encoded': [row['item_encoded']] * len(unit_times),
-        'unit_time': list(unit_times),
-        'release_time': [row['release_time']] * len(unit_times),
-        'pop_history': [row['pop_history']] * len(unit_times),
-        'average_rating': [row['average_rating']] * len(unit_times),
-        'cat_encoded': [row['cat_encoded']] * len(unit_times),
-        'store_encoded': [row['store_encoded']] * len(unit_times)
-    })
-
 def load_data(dataset_name):
     processed_path = f'../../dataset/{dataset_name}/preprocessed/'
-    result_file = f'{processed_path}result_df_pop.pkl'
-
-    if os.path.exists(result_file) and config.data_preprocessed:
-        with open(result_file, 'rb') as file:
-            result_df = pickle.load(file)
-
-        # Extract necessary information from the result_df
-        num_items = result_df['item_encoded'].max() + 1
-        num_cats = result_df['cat_encoded'].max() + 1
-        num_stores = result_df['store_encoded'].max() + 1
-        max_time = result_df["unit_time"].max()
-
-        return result_df, num_items, num_cats, num_stores, max_time
-
-    combined_df = None      
-    with open(f'{processed_path}train_df_pop.pkl', 'rb') as file:
-        train_df = pickle.load(file)
-    with open(f'{processed_path}valid_df_pop.pkl', 'rb') as file:
-        valid_df = pickle.load(file)
-    with open(f'{processed_path}test_df_pop.pkl', 'rb') as file:
-        test_df = pickle.load(file)
-
-    combined_df = pd.concat([train_df, valid_df, test_df])
-    max_time = combined_df["unit_time"].max()
-
-    first_df = combined_df.drop_duplicates(subset='item_encoded', keep='first')
-    first_df = first_df[['item_encoded', 'release_time', 'pop_history','average_rating', 'cat_encoded', 'store_encoded']]
-    num_items = first_df['item_encoded'].max() + 1
-    num_cats = first_df['cat_encoded'].max() + 1
-    num_stores = first_df['store_encoded'].max() + 1
-
-    result_df = pd.concat([expand_time(row, max_time) for _, row in first_df.iterrows()]).reset_index(drop=True)
-
-    if not os.path.exists(processed_path):
-        os.makedirs(processed_path)
-    result_df.to_pickle(result_file)
+    store_path = PreprocessCache(processed_path, dataset_sources(dataset_name), config).lookup()
+    if store_path is None:
+        raise FileNotFoundError(f"No preprocessed popularity store for {dataset_name} in {processed_path}, run main.py first")
 
-    if 'df' in locals():
-        del df
+    item_columns, pop_counts, meta = load_pop_store(store_path)
     gc.collect()
 
-    return result_df, num_items, num_cats, num_stores, max_time
+    return item_columns, pop_counts, meta['num_items'], meta['num_cats'], meta['num_stores'], meta['max_time'], meta.get('history_revision', 0)
+
+def refresh_outputs(model, item_columns, pop_counts, max_time, history_revision, device, result_path, chunk_size=65536):
+    """
+    Score only the unit_times after the last scored one, continuing the EMA from
+    the state saved with the predictions, and append the rows to result_path
+    and the new unit_time slabs to the handoff table. The appended rows form
+    one block ordered by item, then unit_time, after the existing rows, so the
+    columns stop being item-major as a whole. Everything is rescored when the
+    store's history or alpha changed since.
+    """
+    meta, outputs = open_columns(result_path)
+    scored_time = meta['max_time']
+    if meta.get('history_revision') != history_revision or meta.get('alpha') != model.module_pop_history.alpha or scored_time > max_time:
+        print("Popularity history changed since the last scoring, rescoring every unit_time")
+        model.module_pop_history.set_pop_counts(pop_counts)
+        model.to(device)
+        return generate_outputs(model, item_columns, max_time, device, result_path, history_revision, chunk_size)
 
-def load_model_state(model, checkpoint_path):
-    checkpoint = torch.load(checkpoint_path)
-    model_state_dict = model.state_dict()
-    new_state_dict = {}
-    for k, v in checkpoint.items():
-        if k in model_state_dict and model_state_dict[k].shape == v.shape:
-            new_state_dict[k] = v
-    model_state_dict.update(new_state_dict)
-    model.load_state_dict(model_state_dict)
-
-def generate_outputs(model, data_loader, device):
     model.eval()
-    all_outputs = []
+    model.module_pop_history.set_ema_state(pop_counts, np.array(outputs['ema_state']), scored_time)
+    model.to(device)
+    del outputs
 
+    # Items released after the last scoring start at their release_time
+    first_times = np.maximum(np.asarray(item_columns['release_time'], dtype=np.int64), scored_time + 1)
+    num_rows = start_rows = meta['columns']['unit_time']['length']
     with torch.no_grad():
-        for batch in tqdm(data_loader, desc="Generating Outputs"):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            weighted_pop_history_output, weighted_time_output, weighted_sideinfo_output, output = model(batch)
-            for i in range(len(batch['item'])):
-                all_outputs.append({
-                    'weighted_pop_history_output': weighted_pop_history_output[i].cpu().numpy(),
-                    'weighted_time_output': weighted_time_output[i].cpu().numpy(),
-                    'weighted_sideinfo_output': weighted_sideinfo_output[i].cpu().numpy()
-                })
-
-    return all_outputs
+        chunks = score_chunks(model, item_columns, first_times, max_time, device, chunk_size)
+        for chunk in tqdm(chunks, total=-(-len(first_times) // chunk_size), desc="Refreshing Outputs"):
+            for name in PREDICTION_COLUMNS:
+                write_column_tail(result_path, meta, name, num_rows, chunk[name])
+            num_rows += len(chunk['unit_time'])
+
+    write_column(result_path, meta, 'ema_state', model.module_pop_history.ema_state(max_time).cpu().numpy())
+    meta.update(max_time=int(max_time), num_scored_items=len(first_times))
+    write_meta(result_path, meta)
+    handoff_path = os.path.join(result_path, HANDOFF_FILE)
+    handoff_header = read_handoff_header(handoff_path)
+    if handoff_header is None or handoff_header['max_time'] != scored_time:
+        write_handoff(handoff_path, open_columns(result_path)[1], max_time)
+    elif max_time > scored_time:
+        # only the appended rows are read back, one new slab per unit_time
+        columns = open_columns(result_path)[1]
+        append_handoff(handoff_path, {name: columns[name][start_rows:num_rows] for name in PREDICTION_COLUMNS}, max_time)
+        del columns
+    if max_time > scored_time:
+        print(f"Appended {num_rows - start_rows} rows for unit_time {scored_time + 1}..{max_time}")
+    else:
+        print(f"Predictions already cover unit_time 0..{max_time}")
+    return meta
 
 def main():
     os.environ['CUDA_VISIBLE_DEVICES'] = '2'  
     dataset_name = config.dataset
-    combined_df, num_items, num_cats, num_stores, max_time = load_data(dataset_name)
+    item_columns, pop_counts, num_items, num_cats, num_stores, max_time, history_revision = load_data(dataset_name)
 
     gc.collect()
 
-    test_dataset = create_datasets(combined_df, combined_df, combined_df)[2]
-    test_loader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=False)
-
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
-    model = PopPredict(config, num_items, num_cats, num_stores, max_time).to(device)
+    if config.device == 'auto':
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(config.device)
 
     latest_checkpoint = f'../../model/pop/{dataset_name}/best_model.pt'
 
     if os.path.exists(latest_checkpoint):
-        load_model_state(model, latest_checkpoint)
+        # table sizes come from the checkpoint, items added since map to index 0
+        model = PopPredict.from_checkpoint(latest_checkpoint, config, map_location=device).to(device)
     else:
         raise FileNotFoundError(f"Checkpoint {latest_checkpoint} not found")
 
-    outputs = generate_outputs(model, test_loader, device)
-    outputs_df = pd.DataFrame(outputs)
-
-    results_df = pd.concat([combined_df.reset_index(drop=True), outputs_df], axis=1)
-    
-    results_df['time_output'] = results_df['weighted_time_output'].apply(lambda x: x[0])
-    results_df['conformity'] = results_df['weighted_pop_history_output'].apply(lambda x: x[0]) + results_df['weighted_time_output'].apply(lambda x: x[0])
-    results_df['quality'] = results_df['weighted_sideinfo_output'].apply(lambda x: x[0]) 
-    results_df = results_df[['item_encoded', 'unit_time', 'weighted_pop_history_output', 'weighted_time_output', 'weighted_sideinfo_output', 'time_output', 'conformity', 'quality']]
-
-    result_path = f'../../dataset/{dataset_name}/pop_{dataset_name}.pkl'
-    os.makedirs(os.path.dirname(result_path), exist_ok=True)
-    results_df.to_pickle(result_path)
+    result_path = f'../../dataset/{dataset_name}/pop_{dataset_name}/'
+    if args.refresh and os.path.exists(os.path.join(result_path, 'meta.json')):
+        refresh_outputs(model, item_columns, pop_counts, max_time, history_revision, device, result_path)
+    else:
+        model.module_pop_history.set_pop_counts(pop_counts)
+        model.to(device)
+        generate_outputs(model, item_columns, max_time, device, result_path, history_revision)
     print(f"Results saved to {result_path}")
-    print("result_df zero ratio\n", len(results_df[results_df['time_output'] == 0])/len(results_df), len(results_df[results_df['conformity'] == 0])/len(results_df), len(results_df[results_df['quality'] == 0])/len(results_df))
+
+    meta, results = open_columns(result_path)
+    num_rows = max(len(results['unit_time']), 1)
+    print("result_df zero ratio\n", (results['time_output'] == 0).sum()/num_rows, (results['conformity'] == 0).sum()/num_rows, (results['quality'] == 0).sum()/num_rows)
 
 if __name__ == "__main__":
     main()
@@ -10,17 +10,130 @@ def load_dataset(file_path, meta = False):
         df = pickle.load(file)         
     return df
 
-def expand_time(row, max_time):
-    unit_times = range(row['release_time'], max_time + 1)
-    return pd.DataFrame({
-        'item_encoded': [row['item_encoded']] * len(unit_times),
-        'unit_time': list(unit_times),
-        'release_time': [row['release_time']] * len(unit_times),
-        'pop_history': [row['pop_history']] * len(unit_times),
-        'average_rating': [row['average_rating']] * len(unit_times),
-        'cat_encoded': [row['cat_encoded']] * len(unit_times),
-        'store_encoded': [row['store_encoded']] * len(unit_times)
-    })
+def expand_items(item_df, max_time):
+    """
+    Expand a per-item table (a DataFrame or a dict of column arrays) into the long
+    (item, unit_time) table, one row per time unit from each item's release_time
+    up to max_time.
+    """
+    release_times = np.asarray(item_df['release_time'], dtype=np.int64)
+    lengths = np.maximum(max_time + 1 - release_times, 0)
+    row_item = np.repeat(np.arange(len(release_times)), lengths)
+    row_start = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    unit_times = np.arange(len(row_item), dtype=np.int64) - row_start + release_times[row_item]
+
+    expanded = {'item_encoded': np.asarray(item_df['item_encoded'])[row_item],
+                'unit_time': unit_times,
+                'release_time': release_times[row_item]}
+    for col in item_df:
+        if col not in expanded:
+            expanded[col] = np.asarray(item_df[col])[row_item]
+    return pd.DataFrame(expanded)
+
+class PopCounts(object):
+    """
+    Sparse interaction counts per (item, unit_time), compressed by time: the
+    items and counts of unit_time t live in items[indptr[t]:indptr[t+1]], sorted
+    by item. Only the slices a batch needs are ever densified.
+    """
+    def __init__(self, indptr, items, counts, num_items):
+        self.indptr = indptr
+        self.items = items
+        self.counts = counts
+        self.num_items = int(num_items)
+        self.max_time = len(indptr) - 2
+        self._keys = None
+
+    @classmethod
+    def from_codes(cls, items, unit_times, num_items, max_time, weights=None):
+        """
+        Count (item, unit_time) codes; weights, if given, are summed instead of
+        counting one per code.
+        """
+        keys = np.asarray(unit_times, dtype=np.int64) * num_items + np.asarray(items, dtype=np.int64)
+        if weights is None:
+            keys, counts = np.unique(keys, return_counts=True)
+        else:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse, weights=weights, minlength=len(keys))
+        key_times = keys // num_items
+        indptr = np.zeros(max_time + 2, dtype=np.int64)
+        np.cumsum(np.bincount(key_times, minlength=max_time + 1), out=indptr[1:])
+        return cls(indptr, (keys - key_times * num_items).astype(np.int32), counts.astype(np.int32), num_items)
+
+    @property
+    def shape(self):
+        return self.num_items, self.max_time + 1
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.items.nbytes + self.counts.nbytes
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            key_times = np.repeat(np.arange(self.max_time + 1, dtype=np.int64), np.diff(self.indptr))
+            self._keys = key_times * self.num_items + self.items
+        return self._keys
+
+    def rollup(self, factor):
+        """
+        Counts at a coarser resolution where each new unit_time spans factor of
+        the current ones.
+        """
+        key_times = self.keys // self.num_items
+        return PopCounts.from_codes(self.items, key_times // factor, self.num_items, self.max_time // factor, weights=self.counts)
+
+    def lookup(self, items, unit_times):
+        """
+        Counts of the given (item, unit_time) pairs as an int32 array.
+        """
+        query = np.asarray(unit_times, dtype=np.int64) * self.num_items + np.asarray(items, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(query.shape, dtype=np.int32)
+        pos = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        return np.where(self.keys[pos] == query, self.counts[pos], 0).astype(np.int32)
+
+    def densify(self, items):
+        """
+        Dense (len(items), max_time + 1) int32 histories of the given items.
+        """
+        items = np.asarray(items, dtype=np.int64)
+        unit_times = np.arange(self.max_time + 1, dtype=np.int64)
+        return self.lookup(items[:, None], unit_times[None, :])
+
+    def to_dense(self):
+        return self.densify(np.arange(self.num_items))
+
+def bucket_times(timestamps, time_unit):
+    """
+    Convert raw review timestamps (datetimes or epoch milliseconds) into integer
+    unit_time codes of time_unit milliseconds, counted from the first bucket.
+    """
+    timestamps = pd.Series(timestamps)
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        millis = timestamps.to_numpy(dtype='datetime64[ms]').astype(np.int64)
+    else:
+        millis = timestamps.to_numpy(dtype=np.int64)
+    codes = millis // time_unit
+    return codes - codes.min()
+
+def build_rollups(item_df, pop_counts, factors):
+    """
+    Roll the finest per-item table and counts up to every factor in factors
+    (in finest time units). Each level is derived from the coarsest level already
+    built that divides it, e.g. day -> month (30) -> quarter (90), so the reviews
+    are never re-grouped. Returns {factor: (item columns, PopCounts)}.
+    """
+    levels = {1: (item_df, pop_counts)}
+    for factor in sorted(set(factors)):
+        base = max(level for level in levels if factor % level == 0)
+        base_items, base_counts = levels[base]
+        step = factor // base
+        items = {col: np.asarray(base_items[col]) for col in base_items}
+        items['release_time'] = items['release_time'] // step
+        levels[factor] = (items, base_counts.rollup(step))
+    return levels
 
 def preprocess_df(df, config): 
     df = df.copy()
@@ -32,19 +145,19 @@ def preprocess_df(df, config):
 
     max_time = df["unit_time"].max()
     print("max_time", max_time)
-    time_range = list(range(0, max_time+1))
+    num_items = df['item_encoded'].max() + 1
+    pop_counts = PopCounts.from_codes(df['item_encoded'].to_numpy(), df['unit_time'].to_numpy(), num_items, max_time)
 
-    count_per_group = df.groupby(['item_encoded', 'unit_time']).size().unstack(fill_value=0)
-    count_per_group = count_per_group.reindex(columns=time_range, fill_value=0)
+    item_df = df.drop_duplicates(subset='item_encoded', keep='first')
+    item_df = item_df[['item_encoded', 'release_time', 'average_rating', 'cat_encoded', 'store_encoded']].reset_index(drop=True)
 
-    df_pop = count_per_group.apply(lambda row: row.tolist(), axis=1)
-    df_pop = df_pop.reset_index(name='pop_history')
+    del df
+    gc.collect()
 
-    first_df = df.drop_duplicates(subset='item_encoded', keep='first')
-    first_df = first_df[['item_encoded', 'release_time', 'average_rating', 'cat_encoded', 'store_encoded']]
-    
-    first_df = first_df.merge(df_pop, on='item_encoded', how='right')
-    result_df = pd.concat([expand_time(row, max_time) for _, row in first_df.iterrows()]).reset_index(drop=True)
+    return item_df, pop_counts, max_time
+
+def split_df(item_df, max_time):
+    result_df = expand_items(item_df, max_time)
 
     train_df = result_df[result_df['unit_time'] <= max_time - 2].reset_index(drop=True)
     valid_df = result_df[result_df['unit_time'] == max_time - 1].reset_index(drop=True)
@@ -57,45 +170,116 @@ def preprocess_df(df, config):
 
     print(f"Train ratio: {train_ratio:.2f}, Valid ratio: {valid_ratio:.2f}, Test ratio: {test_ratio:.2f}")
 
-    del df, first_df, result_df
+    del result_df
     gc.collect()
 
-    return train_df, valid_df, test_df, max_time
+    return train_df, valid_df, test_df
 
 class MakeDataset(Dataset):
-    def __init__(self, items, times, release_times, pop_histories, average_ratings, categories, stores):
+    def __init__(self, items, times, release_times, average_ratings, categories, stores, pop_counts):
         self.items = torch.tensor(items.values, dtype=torch.int)        
         self.times = torch.tensor(times.values, dtype=torch.int)
         self.release_times = torch.tensor(release_times.values, dtype=torch.int)
-        self.pop_histories = [torch.tensor(h, dtype=torch.int) for h in pop_histories]
         self.average_ratings = torch.tensor(average_ratings.values, dtype=torch.float)
         self.categories = torch.tensor(categories.values, dtype=torch.int)
         self.stores = torch.tensor(stores.values, dtype=torch.int)
+        self.pop_gts = torch.from_numpy(pop_counts.lookup(items.values, times.values))
 
     def __len__(self):
         return len(self.items)
+
+    @property
+    def columns(self):
+        return {
+            'item': self.items,
+            'time': self.times,
+            'release_time': self.release_times,
+            'pop_gt': self.pop_gts,
+            'average_rating': self.average_ratings,
+            'category': self.categories,
+            'store': self.stores
+        }
     
     def __getitem__(self, idx):
-        data = {
-            'item': self.items[idx],
-            'time': self.times[idx],
-            'release_time': self.release_times[idx],
-            'pop_history': self.pop_histories[idx],            
-            'average_rating': self.average_ratings[idx],
-            'category': self.categories[idx],
-            'store': self.stores[idx]
+        data = {k: v[idx] for k, v in self.columns.items()}
+        return data
+
+class ItemSequenceDataset(Dataset):
+    """
+    One sample per item holding its popularity at every unit_time up to
+    last_time. Steps before the item's release_time are masked out by
+    release_time, so an epoch covers the same (item, unit_time) pairs as the
+    expanded rows of split_df at roughly 1/T of the memory.
+    """
+    def __init__(self, item_df, pop_counts, last_time):
+        item_df = pd.DataFrame(item_df)
+        item_df = item_df[item_df['release_time'] <= last_time]
+        self.items = torch.tensor(item_df['item_encoded'].values, dtype=torch.int)
+        self.release_times = torch.tensor(item_df['release_time'].values, dtype=torch.int)
+        self.average_ratings = torch.tensor(item_df['average_rating'].values, dtype=torch.float)
+        self.categories = torch.tensor(item_df['cat_encoded'].values, dtype=torch.int)
+        self.stores = torch.tensor(item_df['store_encoded'].values, dtype=torch.int)
+        self.pop_gts = torch.from_numpy(pop_counts.densify(item_df['item_encoded'].values)[:, :last_time + 1])
+        self.num_times = last_time + 1
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def columns(self):
+        return {
+            'item': self.items,
+            'release_time': self.release_times,
+            'pop_gt': self.pop_gts,
+            'average_rating': self.average_ratings,
+            'category': self.categories,
+            'store': self.stores
         }
+
+    def __getitem__(self, idx):
+        data = {k: v[idx] for k, v in self.columns.items()}
         return data
 
-def create_datasets(train_df, valid_df, test_df):
+class TensorBatchIterator(object):
+    """
+    Batches over a MakeDataset built by slicing all of its column tensors with
+    one index permutation per epoch, instead of DataLoader workers fetching and
+    collating sample dicts one by one.
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, device=None, seed=2024):
+        self.columns = {k: v.to(device) if device is not None else v for k, v in dataset.columns.items()}
+        self.num_samples = len(dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.num_samples, generator=self.generator)
+            order = order.to(next(iter(self.columns.values())).device)
+        for batch_idx in range(len(self)):
+            start = batch_idx * self.batch_size
+            if self.shuffle:
+                index = order[start:start + self.batch_size]
+            else:
+                index = slice(start, start + self.batch_size)
+            yield {k: v[index] for k, v in self.columns.items()}
+
+def create_datasets(train_df, valid_df, test_df, pop_counts):
     train_dataset = MakeDataset(
-        train_df['item_encoded'], train_df['unit_time'], train_df['release_time'], train_df['pop_history'],
-        train_df['average_rating'], train_df['cat_encoded'], train_df['store_encoded']
+        train_df['item_encoded'], train_df['unit_time'], train_df['release_time'],
+        train_df['average_rating'], train_df['cat_encoded'], train_df['store_encoded'], pop_counts
     )
     valid_dataset = MakeDataset(
-        valid_df['item_encoded'], valid_df['unit_time'], valid_df['release_time'], valid_df['pop_history'], valid_df['average_rating'], valid_df['cat_encoded'], valid_df['store_encoded']
+        valid_df['item_encoded'], valid_df['unit_time'], valid_df['release_time'], valid_df['average_rating'], valid_df['cat_encoded'], valid_df['store_encoded'], pop_counts
     )
     test_dataset = MakeDataset(
-        test_df['item_encoded'], test_df['unit_time'], test_df['release_time'], test_df['pop_history'], test_df['average_rating'], test_df['cat_encoded'], test_df['store_encoded']
+        test_df['item_encoded'], test_df['unit_time'], test_df['release_time'], test_df['average_rating'], test_df['cat_encoded'], test_df['store_encoded'], pop_counts
     )
-    return train_dataset, valid_dataset, test_dataset
\ No newline at end of file
+    return train_dataset, valid_dataset, test_dataset
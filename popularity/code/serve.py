@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+import traceback
+import urllib.request
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import torch
+
+from storage import load_pop_store, dataset_sources, PreprocessCache
+from Model import PopPredict
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset", type=str, default='14_Sports',
+                    help="dataset file name")
+parser.add_argument("--alpha", type=float, default=0.7,
+                    help="parameter for balance of pop_history and time")
+parser.add_argument("--embedding_dim", type=int, default=64,
+                    help="embedding size, replaced by the checkpoint's")
+parser.add_argument("--time_unit", type=int, default=1000*60*60*24,
+                    help="smallest time unit for model training(default: day)")
+parser.add_argument("--pop_time_unit", type=int, default=30*3,
+                    help="smallest time unit for item popularity statistic")
+parser.add_argument("--bucket_time", action="store_true",
+                    help="serve from the store built from bucketed review timestamps")
+parser.add_argument("--device", type=str, default='cpu',
+                    help="device the model is kept on")
+parser.add_argument("--host", type=str, default='127.0.0.1',
+                    help="address to listen on")
+parser.add_argument("--port", type=int, default=8765,
+                    help="port to listen on (0: any free port)")
+parser.add_argument("--max_batch_size", type=int, default=4096,
+                    help="largest number of (item, unit_time) pairs scored in one forward pass")
+parser.add_argument("--max_wait_ms", type=float, default=2.0,
+                    help="how long the first request of a micro-batch waits for others to join it")
+parser.add_argument("--self_test", type=int, default=0,
+                    help="start the service on a free port, send this many requests from local clients and print the stats")
+parser.add_argument("--clients", type=int, default=16,
+                    help="concurrent client threads for --self_test")
+
+args = parser.parse_args()
+
+def load_model(checkpoint_path, pop_counts, device):
+    """
+    Rebuild PopPredict with the table sizes and embedding_dim of the checkpoint
+    saved by main.py, so a store grown by ingestion still loads every weight.
+    """
+    model = PopPredict.from_checkpoint(checkpoint_path, args, pop_counts, map_location=device)
+    return model.to(device).eval()
+
+def make_score_fn(model, item_columns, max_time, device):
+    """
+    Score arrays of (item, unit_time) pairs with PopPredict.forward. Release
+    time, category and store are looked up by item id from the store.
+    """
+    item_ids = np.asarray(item_columns['item_encoded'], dtype=np.int64)
+    lookup = {}
+    for name in ['release_time', 'cat_encoded', 'store_encoded']:
+        table = np.full(item_ids.max() + 1, -1, dtype=np.int64)
+        table[item_ids] = np.asarray(item_columns[name])
+        lookup[name] = torch.from_numpy(table).to(device)
+
+    def score(items, unit_times):
+        if ((items < 0) | (items >= len(lookup['release_time']))).any() or (lookup['release_time'][items] < 0).any():
+            raise ValueError("unknown item_encoded")
+        if ((unit_times < 0) | (unit_times > max_time)).any():
+            raise ValueError(f"unit_time must be within 0..{max_time}")
+        items = torch.from_numpy(items).to(device)
+        batch = {
+            'item': items,
+            'time': torch.from_numpy(unit_times).to(device),
+            'release_time': lookup['release_time'][items],
+            'category': lookup['cat_encoded'][items],
+            'store': lookup['store_encoded'][items]
+        }
+        with torch.no_grad():
+            pop_history_output, time_output, sideinfo_output, _ = model(batch)
+        conformity = (pop_history_output + time_output).squeeze(1)
+        return conformity.cpu().numpy(), sideinfo_output.squeeze(1).cpu().numpy()
+
+    return score
+
+class MicroBatcher(object):
+    """
+    Coalesce concurrent scoring requests into one forward pass. A worker thread
+    takes the first waiting request, then keeps collecting requests until
+    max_batch_size pairs are queued or max_wait seconds have passed since the
+    first one arrived. Latencies and batch sizes of the last window requests
+    and batches are kept for stats().
+    """
+    def __init__(self, score_fn, max_batch_size=4096, max_wait=0.002, window=10000):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items, unit_times):
+        request = {
+            'items': np.asarray(items, dtype=np.int64).reshape(-1),
+            'unit_times': np.asarray(unit_times, dtype=np.int64).reshape(-1),
+            'start': time.perf_counter(),
+            'done': threading.Event()
+        }
+        if len(request['items']) != len(request['unit_times']):
+            raise ValueError("items and unit_times must have the same length")
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        size = len(batch[0]['items'])
+        deadline = batch[0]['start'] + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request['items'])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            offsets = np.cumsum([0] + [len(request['items']) for request in batch])
+            try:
+                conformity, quality = self.score_fn(np.concatenate([request['items'] for request in batch]),
+                                                    np.concatenate([request['unit_times'] for request in batch]))
+            except Exception:
+                # score requests one by one so a bad request only fails itself
+                conformity, quality = None, None
+            end = time.perf_counter()
+
+            with self.lock:
+                self.num_batches += 1
+                self.batch_sizes.append(int(offsets[-1]))
+                for i, request in enumerate(batch):
+                    try:
+                        if conformity is None:
+                            request_conformity, request_quality = self.score_fn(request['items'], request['unit_times'])
+                        else:
+                            request_conformity, request_quality = conformity[offsets[i]:offsets[i+1]], quality[offsets[i]:offsets[i+1]]
+                        request['result'] = {'conformity': request_conformity.tolist(), 'quality': request_quality.tolist()}
+                    except Exception as e:
+                        request['error'] = e
+                    self.num_requests += 1
+                    self.latencies.append(end - request['start'])
+                    request['done'].set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            return {
+                'requests': self.num_requests,
+                'batches': self.num_batches,
+                'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'batch_size_mean': float(batch_sizes.mean()) if len(batch_sizes) else None,
+                'batch_size_max': int(batch_sizes.max()) if len(batch_sizes) else None
+            }
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """
+    POST /score with {"item_encoded": ..., "unit_time": ...}, either single
+    values or equally long lists, returns conformity and quality in the same
+    shape. GET /stats returns the batcher counters.
+    """
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._reply(404, {'error': f"unknown path {self.path}"})
+            return
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            result = self.server.batcher.submit(query['item_encoded'], query['unit_time'])
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # anything else is a scoring failure, the client still gets an answer
+            traceback.print_exc()
+            self._reply(500, {'error': f"scoring failed: {e}"})
+            return
+        if not isinstance(query['item_encoded'], list):
+            result = {k: v[0] for k, v in result.items()}
+        self._reply(200, result)
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *log_args):
+        pass
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # room for bursts of concurrent clients while the handler threads start
+    request_queue_size = 128
+
+def request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})) as response:
+        return json.loads(response.read())
+
+def self_test(url, score_fn, item_columns, max_time):
+    """
+    Send single-pair requests from concurrent client threads plus one bulk
+    request, and check every answer against scoring the pairs directly.
+    """
+    rng = random.Random(2024)
+    item_ids = np.asarray(item_columns['item_encoded'])
+    queries = [(int(rng.choice(item_ids)), rng.randint(0, max_time)) for _ in range(args.self_test)]
+    answers = [None] * len(queries)
+
+    def client(worker):
+        for i in range(worker, len(queries), args.clients):
+            answers[i] = request(f'{url}/score', {'item_encoded': queries[i][0], 'unit_time': queries[i][1]})
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(worker,)) for worker in range(args.clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    bulk = request(f'{url}/score', {'item_encoded': [q[0] for q in queries], 'unit_time': [q[1] for q in queries]})
+
+    conformity, quality = score_fn(np.array([q[0] for q in queries]), np.array([q[1] for q in queries]))
+    single_error = max(max(abs(a['conformity'] - c), abs(a['quality'] - q)) for a, c, q in zip(answers, conformity, quality))
+    bulk_error = max(np.abs(np.array(bulk['conformity']) - conformity).max(), np.abs(np.array(bulk['quality']) - quality).max())
+    print(f"{len(queries)} requests from {args.clients} clients in {elapsed:.2f}s ({len(queries) / elapsed:.0f} requests/sec)")
+    print(f"max abs difference to direct scoring: single {single_error:.2e}, bulk {bulk_error:.2e}")
+    print(f"stats: {request(f'{url}/stats')}")
+
+def main():
+    processed_path = f'../../dataset/{args.dataset}/preprocessed/'
+    store_path = PreprocessCache(processed_path, dataset_sources(args.dataset), args).lookup()
+    if store_path is None:
+        raise FileNotFoundError(f"No preprocessed popularity store for {args.dataset} in {processed_path}, run main.py first")
+    checkpoint_path = f'../../model/pop/{args.dataset}/best_model.pt'
+    if not os.path.exists(checkpoint_path):
+        raise FileNotFoundError(f"Checkpoint {checkpoint_path} not found")
+
+    device = torch.device(args.device)
+    item_columns, pop_counts, meta = load_pop_store(store_path)
+    model = load_model(checkpoint_path, pop_counts, device)
+    score_fn = make_score_fn(model, item_columns, meta['max_time'], device)
+
+    server = ScoringServer((args.host, 0 if args.self_test else args.port), ScoringHandler)
+    server.batcher = MicroBatcher(score_fn, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    url = f'http://{server.server_address[0]}:{server.server_address[1]}'
+
+    if args.self_test:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self_test(url, score_fn, item_columns, meta['max_time'])
+        server.shutdown()
+    else:
+        print(f"Serving {args.dataset} popularity scores for unit_time 0..{meta['max_time']} on {url}")
+        server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+import os
+import copy
+import json
+import shutil
+import hashlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from preprocess import PopCounts
+
+STORE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+# Config fields that change the preprocessed artifacts
+CACHE_FIELDS = ('dataset', 'time_unit', 'pop_time_unit', 'bucket_time')
+
+ITEM_COLUMNS = {
+    'item_encoded': np.int32,
+    'release_time': np.int32,
+    'average_rating': np.float32,
+    'cat_encoded': np.int32,
+    'store_encoded': np.int32
+}
+
+PREDICTION_COLUMNS = {
+    'item_encoded': np.int32,
+    'unit_time': np.int32,
+    'time_output': np.float32,
+    'conformity': np.float32,
+    'quality': np.float32
+}
+
+# Dense (unit_time, item) table of conformity and quality handed to the
+# interest pipeline: a fixed header, then one slab per unit_time holding the
+# float32 values of item_capacity items and a uint8 mask of the scored ones.
+# Time-major slabs let a refresh append new unit_times without moving the rest
+HANDOFF_FILE = 'pop_table.f32'
+HANDOFF_MAGIC = b'POPTABLE'
+HANDOFF_VERSION = 2
+HANDOFF_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('num_items', '<u4'), ('max_time', '<u4'), ('item_capacity', '<u4'), ('reserved', 'V40')])
+
+def handoff_slab(item_capacity):
+    return np.dtype([('values', '<f4', (item_capacity, 2)), ('valid', 'u1', (item_capacity,))])
+
+def write_columns(store_path, columns, meta):
+    """
+    Write each column as a raw little-endian .bin file and describe dtypes and
+    lengths in meta.json, so the store can be memory-mapped without unpickling.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    meta = dict(meta, version=STORE_VERSION, columns={})
+    for name, values in columns.items():
+        write_column(store_path, meta, name, values)
+    write_meta(store_path, meta)
+    return meta
+
+def write_column(store_path, meta, name, values):
+    """
+    Write or replace one column. Only meta is updated; call write_meta once all
+    columns are written.
+    """
+    values = np.ascontiguousarray(values)
+    values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+    values.tofile(os.path.join(store_path, f'{name}.bin'))
+    meta['columns'][name] = {'dtype': values.dtype.str, 'length': len(values)}
+
+def create_columns(store_path, dtypes, length, meta):
+    """
+    Preallocate length rows of every column as writable memmaps so results can be
+    streamed in chunk by chunk. Any previous meta.json is removed and the returned
+    meta is only written by the caller once every column is filled and flushed.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    if os.path.exists(os.path.join(store_path, 'meta.json')):
+        os.remove(os.path.join(store_path, 'meta.json'))
+    meta = dict(meta, version=STORE_VERSION, columns={})
+    columns = {}
+    for name, dtype in dtypes.items():
+        dtype = np.dtype(dtype).newbyteorder('<')
+        column_path = os.path.join(store_path, f'{name}.bin')
+        if length == 0:
+            open(column_path, 'wb').close()
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(column_path, dtype=dtype, mode='w+', shape=(int(length),))
+        meta['columns'][name] = {'dtype': dtype.str, 'length': int(length)}
+    return meta, columns
+
+def read_meta(store_path):
+    with open(os.path.join(store_path, 'meta.json'), 'r') as file:
+        meta = json.load(file)
+    if meta.get('version') != STORE_VERSION:
+        raise ValueError(f"Unsupported store version {meta.get('version')} in {store_path}")
+    return meta
+
+def write_meta(store_path, meta):
+    tmp_path = os.path.join(store_path, 'meta.json.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(meta, file, indent=2)
+    os.replace(tmp_path, os.path.join(store_path, 'meta.json'))
+
+def write_column_tail(store_path, meta, name, offset, values):
+    """
+    Overwrite column name from row offset on with values, truncating whatever
+    followed. Only meta is updated; call write_meta once all columns are written.
+    """
+    column = meta['columns'][name]
+    values = np.ascontiguousarray(values, dtype=np.dtype(column['dtype']))
+    with open(os.path.join(store_path, f'{name}.bin'), 'r+b') as file:
+        file.seek(offset * values.itemsize)
+        file.write(values.tobytes())
+        file.truncate()
+    column['length'] = offset + len(values)
+
+def open_columns(store_path):
+    """
+    Memory-map every column of a store copy-on-write: pages are shared between
+    processes reading the same store and are only copied if a process writes.
+    """
+    meta = read_meta(store_path)
+    columns = {}
+    for name, column in meta['columns'].items():
+        dtype = np.dtype(column['dtype'])
+        if column['length'] == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(store_path, f'{name}.bin'), dtype=dtype, mode='c', shape=(column['length'],))
+    return meta, columns
+
+def read_handoff_header(handoff_path):
+    """
+    Header of the handoff file at handoff_path, or None when it is missing or
+    was written with another layout version.
+    """
+    if not os.path.exists(handoff_path):
+        return None
+    header = np.fromfile(handoff_path, dtype=HANDOFF_HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] != HANDOFF_MAGIC or header['version'][0] != HANDOFF_VERSION:
+        return None
+    return {name: int(header[name][0]) for name in ['num_items', 'max_time', 'item_capacity']}
+
+def _write_handoff_header(file, num_items, max_time, item_capacity):
+    header = np.zeros(1, dtype=HANDOFF_HEADER)
+    header['magic'], header['version'] = HANDOFF_MAGIC, HANDOFF_VERSION
+    header['num_items'], header['max_time'], header['item_capacity'] = num_items, max_time, item_capacity
+    file.seek(0)
+    file.write(header.tobytes())
+
+def _scatter_handoff(slabs, first_time, columns, block_rows=1 << 20):
+    # a fixed block of rows at a time keeps memory flat for memory-mapped columns
+    for start in range(0, len(columns['item_encoded']), block_rows):
+        end = start + block_rows
+        items = np.asarray(columns['item_encoded'][start:end], dtype=np.int64)
+        unit_times = np.asarray(columns['unit_time'][start:end], dtype=np.int64) - first_time
+        slabs['values'][unit_times, items, 0] = columns['conformity'][start:end]
+        slabs['values'][unit_times, items, 1] = columns['quality'][start:end]
+        slabs['valid'][unit_times, items] = 1
+    slabs.flush()
+
+def write_handoff(handoff_path, columns, max_time):
+    """
+    Scatter the prediction columns into the dense handoff table at handoff_path.
+    The file is written next to the target and renamed over it when complete.
+    """
+    items = np.asarray(columns['item_encoded'])
+    num_items = int(items.max()) + 1 if len(items) else 1
+    # whole float32 values per slab keep every slab 4-byte aligned
+    item_capacity = -(-num_items // 4) * 4
+    slab = handoff_slab(item_capacity)
+
+    tmp_path = f'{handoff_path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        _write_handoff_header(file, num_items, max_time, item_capacity)
+        file.truncate(HANDOFF_HEADER.itemsize + (int(max_time) + 1) * slab.itemsize)
+    slabs = np.memmap(tmp_path, dtype=slab, mode='r+', offset=HANDOFF_HEADER.itemsize, shape=(int(max_time) + 1,))
+    _scatter_handoff(slabs, 0, columns)
+    del slabs
+    os.replace(tmp_path, handoff_path)
+    return num_items
+
+def _widen_handoff(handoff_path, header, item_capacity, block_times=64):
+    # copy the slabs into wider ones a block of unit_times at a time
+    old_slab, slab = handoff_slab(header['item_capacity']), handoff_slab(item_capacity)
+    num_times = header['max_time'] + 1
+    tmp_path = f'{handoff_path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        _write_handoff_header(file, header['num_items'], header['max_time'], item_capacity)
+        file.truncate(HANDOFF_HEADER.itemsize + num_times * slab.itemsize)
+    old_slabs = np.memmap(handoff_path, dtype=old_slab, mode='r', offset=HANDOFF_HEADER.itemsize, shape=(num_times,))
+    slabs = np.memmap(tmp_path, dtype=slab, mode='r+', offset=HANDOFF_HEADER.itemsize, shape=(num_times,))
+    for start in range(0, num_times, block_times):
+        end = min(start + block_times, num_times)
+        slabs['values'][start:end, :header['item_capacity']] = old_slabs['values'][start:end]
+        slabs['valid'][start:end, :header['item_capacity']] = old_slabs['valid'][start:end]
+    slabs.flush()
+    del old_slabs, slabs
+    os.replace(tmp_path, handoff_path)
+
+def append_handoff(handoff_path, columns, max_time):
+    """
+    Add the prediction rows of the unit_times after the handoff file's max_time
+    in place: the file grows by one slab per new unit_time and the header is
+    bumped last. Slabs are widened by a quarter when new items no longer fit,
+    so only that rare step rewrites the earlier unit_times.
+    """
+    header = read_handoff_header(handoff_path)
+    items = np.asarray(columns['item_encoded'])
+    num_items = max(header['num_items'], int(items.max()) + 1 if len(items) else 0)
+    if num_items > header['item_capacity']:
+        item_capacity = -(-max(num_items, header['item_capacity'] * 5 // 4) // 4) * 4
+        _widen_handoff(handoff_path, header, item_capacity)
+        header['item_capacity'] = item_capacity
+
+    slab = handoff_slab(header['item_capacity'])
+    first_time = header['max_time'] + 1
+    with open(handoff_path, 'r+b') as file:
+        file.truncate(HANDOFF_HEADER.itemsize + (int(max_time) + 1) * slab.itemsize)
+    slabs = np.memmap(handoff_path, dtype=slab, mode='r+', offset=HANDOFF_HEADER.itemsize + first_time * slab.itemsize,
+                      shape=(int(max_time) + 1 - first_time,))
+    _scatter_handoff(slabs, first_time, columns)
+    del slabs
+    with open(handoff_path, 'r+b') as file:
+        _write_handoff_header(file, num_items, max_time, header['item_capacity'])
+    return num_items
+
+def save_pop_store(store_path, item_df, pop_counts, max_time):
+    columns = {name: np.asarray(item_df[name], dtype=dtype) for name, dtype in ITEM_COLUMNS.items()}
+    columns['count_indptr'] = np.asarray(pop_counts.indptr, dtype=np.int64)
+    columns['count_items'] = np.asarray(pop_counts.items, dtype=np.int32)
+    columns['count_values'] = np.asarray(pop_counts.counts, dtype=np.int32)
+    meta = {
+        'max_time': int(max_time),
+        'num_items': pop_counts.num_items,
+        'num_cats': int(columns['cat_encoded'].max()) + 1,
+        'num_stores': int(columns['store_encoded'].max()) + 1,
+        'splits': split_bounds(max_time)
+    }
+    return write_columns(store_path, columns, meta)
+
+def split_bounds(max_time):
+    # Same boundaries as preprocess.split_df
+    return {'train_end': int(max_time) - 2, 'valid_time': int(max_time) - 1, 'test_time': int(max_time)}
+
+def load_pop_store(store_path):
+    """
+    Open a popularity store written by save_pop_store. Returns the per-item
+    columns, the interaction counts and the store metadata, all backed by mmap.
+    """
+    meta, columns = open_columns(store_path)
+    item_columns = {name: columns[name] for name in ITEM_COLUMNS}
+    pop_counts = PopCounts(columns['count_indptr'], columns['count_items'], columns['count_values'], meta['num_items'])
+    return item_columns, pop_counts, meta
+
+def ingest_events(store_path, events_df):
+    """
+    Add newly arrived interactions to a popularity store in place.
+
+    events_df holds one row per interaction with item_encoded and unit_time, plus
+    average_rating, cat_encoded and store_encoded for items new to the store.
+    Only the count columns from the earliest new unit_time on are rewritten and
+    new items are appended, so the cost follows the size of the new batch rather
+    than the whole history.
+    """
+    meta, columns = open_columns(store_path)
+    if len(events_df) == 0:
+        print("No new events to ingest")
+        return meta
+    old_max_time = meta['max_time']
+    items = events_df['item_encoded'].to_numpy(dtype=np.int64)
+    unit_times = events_df['unit_time'].to_numpy(dtype=np.int64)
+    max_time = max(old_max_time, int(unit_times.max()))
+    num_items = max(meta['num_items'], int(items.max()) + 1)
+
+    # Re-count every (item, unit_time) cell from the earliest touched unit_time on
+    first_time = int(unit_times.min())
+    indptr = np.array(columns['count_indptr'])
+    first_tail_time = min(first_time, old_max_time + 1)
+    tail_start = int(indptr[first_tail_time])
+    tail_times = np.repeat(np.arange(first_tail_time, old_max_time + 1, dtype=np.int64), np.diff(indptr[first_tail_time:]))
+    tail_counts = PopCounts.from_codes(
+        np.concatenate([columns['count_items'][tail_start:], items]),
+        np.concatenate([tail_times, unit_times]),
+        num_items, max_time,
+        weights=np.concatenate([columns['count_values'][tail_start:], np.ones(len(items), dtype=np.int64)])
+    )
+    new_indptr = np.concatenate([indptr[:first_tail_time + 1], tail_start + tail_counts.indptr[first_tail_time + 1:]])
+
+    # Release times of known items only move if events arrive before them
+    event_df = pd.DataFrame({'item_encoded': items, 'unit_time': unit_times})
+    first_seen = event_df.groupby('item_encoded')['unit_time'].min()
+    known_items = pd.Index(np.asarray(columns['item_encoded']))
+    positions = known_items.get_indexer(first_seen.index)
+    known = positions >= 0
+    release_times = np.asarray(columns['release_time'])
+    earlier = known.copy()
+    earlier[known] = first_seen.to_numpy()[known] < release_times[positions[known]]
+
+    new_item_df = events_df[events_df['item_encoded'].isin(first_seen.index[~known])]
+    new_item_df = new_item_df.sort_values('unit_time').drop_duplicates(subset='item_encoded', keep='first')
+    new_item_df = new_item_df.assign(release_time=new_item_df['unit_time'])
+
+    earlier_positions = positions[earlier]
+    earlier_releases = first_seen.to_numpy()[earlier]
+    del columns, known_items, release_times
+
+    write_column_tail(store_path, meta, 'count_indptr', first_tail_time + 1, new_indptr[first_tail_time + 1:])
+    write_column_tail(store_path, meta, 'count_items', tail_start, tail_counts.items)
+    write_column_tail(store_path, meta, 'count_values', tail_start, tail_counts.counts)
+    for name, dtype in ITEM_COLUMNS.items():
+        write_column_tail(store_path, meta, name, meta['columns'][name]['length'], new_item_df[name].to_numpy(dtype=dtype))
+    if len(earlier_positions) > 0:
+        release_column = np.memmap(os.path.join(store_path, 'release_time.bin'), dtype=np.dtype(meta['columns']['release_time']['dtype']),
+                                   mode='r+', shape=(meta['columns']['release_time']['length'],))
+        release_column[earlier_positions] = earlier_releases
+        release_column.flush()
+        del release_column
+
+    meta['max_time'] = max_time
+    meta['num_items'] = num_items
+    # Anything derived from the old history (e.g. saved EMA state) is stale when
+    # counts at or before the old max_time changed or releases moved earlier
+    if first_time <= old_max_time or len(earlier_positions) > 0:
+        meta['history_revision'] = meta.get('history_revision', 0) + 1
+    if len(new_item_df) > 0:
+        meta['num_cats'] = max(meta['num_cats'], int(new_item_df['cat_encoded'].max()) + 1)
+        meta['num_stores'] = max(meta['num_stores'], int(new_item_df['store_encoded'].max()) + 1)
+    meta['splits'] = split_bounds(max_time)
+    write_meta(store_path, meta)
+
+    print(f"Ingested {len(events_df)} events: {len(new_item_df)} new items, max_time {old_max_time} -> {max_time}")
+    return meta
+
+def dataset_sources(dataset_name):
+    """
+    Raw dataset files the popularity preprocessing of dataset_name reads.
+    """
+    sources = [f'../../dataset/{dataset_name}/{dataset_name}.pkl']
+    if dataset_name[:8] == 'sampled_':
+        sources.insert(0, f'../../dataset/{dataset_name[8:]}/{dataset_name[8:]}.pkl')
+    return sources
+
+def file_digest(file_path, chunk_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class PreprocessCache(object):
+    """
+    Content-addressed cache of popularity stores. Every store lives in
+    pop_store_<key>/ where key hashes the source file contents and the
+    CACHE_FIELDS of the config; manifest.json records what produced each store.
+    """
+    def __init__(self, processed_path, source_paths, config, **overrides):
+        self.processed_path = processed_path
+        self.manifest_path = os.path.join(processed_path, MANIFEST_FILE)
+        self.manifest = self._load_manifest()
+        self.sources = [self._describe_source(path) for path in source_paths]
+        self._set_config_fields(dict({field: getattr(config, field) for field in CACHE_FIELDS}, **overrides))
+
+    def _set_config_fields(self, config_fields):
+        self.config_fields = config_fields
+        payload = {
+            'version': STORE_VERSION,
+            'sources': [source['sha256'] for source in self.sources],
+            'config': self.config_fields
+        }
+        self.key = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        self.store_path = os.path.join(self.processed_path, f'pop_store_{self.key[:16]}/')
+
+    def derive(self, **overrides):
+        """
+        Cache entry for the same sources with some config fields overridden,
+        without hashing the sources again.
+        """
+        derived = copy.copy(self)
+        derived.manifest = derived._load_manifest()
+        derived._set_config_fields(dict(self.config_fields, **overrides))
+        return derived
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as file:
+                return json.load(file)
+        return {'version': STORE_VERSION, 'artifacts': {}}
+
+    def _save_manifest(self):
+        os.makedirs(self.processed_path, exist_ok=True)
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _describe_source(self, path):
+        # Reuse the recorded digest while size and mtime are unchanged, like git's index
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        for entry in self.manifest['artifacts'].values():
+            for source in entry['sources']:
+                if source['path'] == path and source['size'] == stat.st_size and source['mtime_ns'] == stat.st_mtime_ns:
+                    return dict(source)
+        return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_digest(path)}
+
+    def _drop_stale(self):
+        current = {source['path']: source['sha256'] for source in self.sources}
+        stale_keys = [key for key, entry in self.manifest['artifacts'].items()
+                      if any(source['path'] in current and source['sha256'] != current[source['path']] for source in entry['sources'])]
+        for key in stale_keys:
+            entry = self.manifest['artifacts'].pop(key)
+            print(f"Removing stale preprocessed artifact {entry['artifact']} (source dataset changed)")
+            shutil.rmtree(os.path.join(self.processed_path, entry['artifact']), ignore_errors=True)
+        if stale_keys:
+            self._save_manifest()
+
+    def lookup(self):
+        """
+        Path of the cached store for the current sources and config, or None.
+        """
+        self._drop_stale()
+        entry = self.manifest['artifacts'].get(self.key)
+        if entry is None or not os.path.exists(os.path.join(self.store_path, 'meta.json')):
+            return None
+        return self.store_path
+
+    def latest(self):
+        """
+        Most recently recorded store built with the current config, whatever its
+        sources, as a (key, store path) pair or (None, None).
+        """
+        entries = [(entry['created'], key) for key, entry in self.manifest['artifacts'].items()
+                   if entry['config'] == self.config_fields]
+        if not entries:
+            return None, None
+        key = max(entries)[1]
+        return key, os.path.join(self.processed_path, self.manifest['artifacts'][key]['artifact'], '')
+
+    def record(self, ingested=None):
+        self.manifest = self._load_manifest()
+        self.manifest['artifacts'][self.key] = {
+            'artifact': os.path.basename(os.path.normpath(self.store_path)),
+            'sources': self.sources,
+            'config': self.config_fields,
+            'store_version': STORE_VERSION,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'ingested': ingested or []
+        }
+        self._save_manifest()
+
+    def adopt(self, key, ingest_record):
+        """
+        Re-key the store of manifest entry key to the current sources after new
+        events were ingested into it, so the next lookup reuses it. Stores of
+        the same sources built with other config fields (e.g. the --bucket_time
+        rollups) lack the new events and are removed.
+        """
+        entry = self.manifest['artifacts'].pop(key)
+        current = {source['path'] for source in self.sources}
+        sibling_keys = [sibling_key for sibling_key, sibling in self.manifest['artifacts'].items()
+                        if any(source['path'] in current for source in sibling['sources'])]
+        for sibling_key in sibling_keys:
+            sibling = self.manifest['artifacts'].pop(sibling_key)
+            print(f"Removing preprocessed artifact {sibling['artifact']} (misses the ingested events)")
+            shutil.rmtree(os.path.join(self.processed_path, sibling['artifact']), ignore_errors=True)
+        self._save_manifest()
+        old_path = os.path.join(self.processed_path, entry['artifact'])
+        if os.path.normpath(old_path) != os.path.normpath(self.store_path):
+            shutil.rmtree(self.store_path, ignore_errors=True)
+            os.replace(old_path, self.store_path)
+        self.record(ingested=entry.get('ingested', []) + [ingest_record])
@@ -1,3 +1,8 @@
+import os
+import time
+import contextlib
+import itertools
+import multiprocessing as mp
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -5,111 +10,156 @@ import torch.nn as nn
 
 import torch.cuda.amp as amp
 
+def autocast(config, device):
+    """
+    fp16 autocast on CUDA as before, bf16 on either device with config.bf16, and
+    plain fp32 on CPU otherwise.
+    """
+    if device.type == 'cuda':
+        return torch.autocast('cuda', dtype=torch.bfloat16 if config.bf16 else torch.float16)
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=config.bf16)
+
+def grad_scaler(config, device):
+    # Loss scaling is only needed for fp16 on CUDA
+    return amp.GradScaler(enabled=device.type == 'cuda' and not config.bf16)
+
+def squared_errors(outputs, batch):
+    """
+    Per-sample squared errors of pop_history, time, sideinfo and final output as a
+    (4, B) tensor, in the order of loss_p, loss_t, loss_s and loss_o.
+    """
+    pop_gt = batch['pop_gt'].float()
+    pop_history_output, time_output, sideinfo_output, output = [o.float().reshape(pop_gt.shape) for o in outputs]
+    avg_rating = batch['average_rating'].reshape(len(pop_gt), *[1] * (pop_gt.dim() - 1))
+    scaled_avg_rating = avg_rating * (pop_gt / 5.0)
+    return torch.stack([(pop_history_output - pop_gt) ** 2, (time_output - pop_gt) ** 2,
+                        (sideinfo_output - scaled_avg_rating) ** 2, (output - pop_gt) ** 2])
+
+def weighted_loss(config, term_means):
+    return config.wt_pop * term_means[0] + config.wt_time * term_means[1] + config.wt_side * term_means[2] + term_means[3]
+
 def train(config, model, data_loader, optimizer, device):
+    device = torch.device(device)
     model.train()
-    total_loss = 0
-    criteria = nn.MSELoss()
-    scaler = amp.GradScaler()  
+    total_loss = torch.zeros((), device=device)
+    scaler = grad_scaler(config, device)
+    num_samples = 0
+    start_time = time.perf_counter()
 
     for batch in tqdm(data_loader, desc="Training"):
         batch = {k: v.to(device) for k, v in batch.items()}
+        num_samples += len(batch['item'])
         optimizer.zero_grad()
         
-        with amp.autocast():  
-            pop_history_output, time_output, sideinfo_output, output = model(batch)
-
-            target_index = batch['time'].long().unsqueeze(1)
-            pop_gt = torch.gather(batch['pop_history'], 1, target_index).squeeze().float()
-            # print("pop_gt", pop_gt)
-            avg_rating = batch['average_rating']            
-            scaled_avg_rating = avg_rating * (pop_gt / 5.0)
-            # print("scaled_avg_rating", scaled_avg_rating)
-
-            loss_p = criteria(pop_history_output.squeeze(), pop_gt)
-            loss_t = criteria(time_output.squeeze(), pop_gt)
-            loss_s = criteria(sideinfo_output.squeeze(), scaled_avg_rating)
-            loss_o = criteria(output.squeeze(), pop_gt)
-            loss = config.wt_pop * loss_p + config.wt_time * loss_t + config.wt_side * loss_s + loss_o
+        with autocast(config, device):
+            outputs = model(batch)
+            loss = weighted_loss(config, squared_errors(outputs, batch).mean(1))
 
         scaler.scale(loss).backward()
         scaler.step(optimizer)
         scaler.update()
-        total_loss += loss.item()
+        total_loss += loss.detach()
 
-        torch.cuda.empty_cache()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
 
-    average_loss = total_loss / len(data_loader)
+    average_loss = total_loss.item() / len(data_loader)
+    print(f"Training throughput: {num_samples / (time.perf_counter() - start_time):.0f} samples/sec")
     
     return average_loss
 
-def evaluate(config, model, data_loader, device):
-    model.eval()
-    total_loss = 0
-    total_rmse = 0
-    criteria = nn.MSELoss()
+def masked_mse(pred, target, mask):
+    return ((pred - target) ** 2 * mask).sum() / mask.sum().clamp(min=1)
 
-    with torch.no_grad():
-        for batch in tqdm(data_loader, desc="Evaluating"):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            pop_history_output, time_output, sideinfo_output, output = model(batch)
+def train_sequence(config, model, data_loader, optimizer, device):
+    """
+    train() over an ItemSequenceDataset: each batch row is an item scored at
+    every unit_time, and cells before its release_time are masked so each loss
+    is the mean over the same (item, unit_time) pairs as the per-row MSE.
+    """
+    device = torch.device(device)
+    model.train()
+    total_loss = torch.zeros((), device=device)
+    scaler = grad_scaler(config, device)
+    num_samples = torch.zeros((), device=device)
+    start_time = time.perf_counter()
 
-            target_index = batch['time'].long().unsqueeze(1)
-            pop_gt = torch.gather(batch['pop_history'], 1, target_index).squeeze().float()
-            avg_rating = batch['average_rating']
-            scaled_avg_rating = avg_rating * (pop_gt / 5.0)
+    for batch in tqdm(data_loader, desc="Training"):
+        batch = {k: v.to(device) for k, v in batch.items()}
+        times = torch.arange(batch['pop_gt'].size(1), device=device)
+        mask = (times.unsqueeze(0) >= batch['release_time'].unsqueeze(1)).float()
+        num_samples += mask.sum()
+        optimizer.zero_grad()
 
-            loss_p = criteria(pop_history_output.squeeze(), pop_gt)
-            loss_t = criteria(time_output.squeeze(), pop_gt)
-            loss_s = criteria(sideinfo_output.squeeze(), scaled_avg_rating)
-            loss_o = criteria(output.squeeze(), pop_gt)
-            loss = config.wt_pop * loss_p + config.wt_time * loss_t + config.wt_side * loss_s + loss_o
-            # loss = criteria(output.squeeze(), pop_gt)
+        with autocast(config, device):
+            outputs = model.forward_sequence(batch, times)
+            term_means = (squared_errors(outputs, batch) * mask).sum((1, 2)) / mask.sum().clamp(min=1)
+            loss = weighted_loss(config, term_means)
 
-            total_loss += loss.item()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        total_loss += loss.detach()
+
+        if device.type == 'cuda':
             torch.cuda.empty_cache()
 
-            mse = loss.item()
-            rmse = np.sqrt(mse)
-            total_rmse += rmse
+    average_loss = total_loss.item() / len(data_loader)
+    print(f"Training throughput: {num_samples.item() / (time.perf_counter() - start_time):.0f} samples/sec")
 
-    average_loss = total_loss / len(data_loader)
-    average_rmse = total_rmse / len(data_loader)
-    
-    return average_loss, average_rmse
+    return average_loss
 
-def test(config, model, test_loader, device):
+def evaluate_sums(config, model, batches, device):
+    """
+    Sum squared errors over all batches on device and reduce once: the loss is the
+    weighted per-sample mean and the RMSE is that of the final output, over the
+    whole split rather than averaged per batch.
+    """
+    device = torch.device(device)
     model.eval()
-    test_loss = 0.0
-    test_rmse = 0.0
-    criteria = nn.MSELoss()
+    sums = torch.zeros(4, device=device)
+    num_samples = 0
 
     with torch.no_grad():
-        for batch in test_loader:
-            batch = {k: v.to(device) for k, v in batch.items()}  
-
-            pop_history_output, time_output, sideinfo_output, output = model(batch)
-
-            target_index = batch['time'].long().unsqueeze(1)
-            pop_gt = torch.gather(batch['pop_history'], 1, target_index).squeeze().float()
-            
-            avg_rating = batch['average_rating']
-            scaled_avg_rating = avg_rating * (pop_gt / 5.0)
-            
-            loss_p = criteria(pop_history_output.squeeze(), pop_gt)
-            loss_t = criteria(time_output.squeeze(), pop_gt)
-            loss_s = criteria(sideinfo_output.squeeze(), scaled_avg_rating)
-            loss_o = criteria(output.squeeze(), pop_gt)
-            loss = config.wt_pop * loss_p + config.wt_time * loss_t + config.wt_side * loss_s + loss_o
-            
-            test_loss += loss.item()
-            torch.cuda.empty_cache()
+        for batch in batches:
+            batch = {k: v.to(device) for k, v in batch.items()}
+            with autocast(config, device):
+                outputs = model(batch)
+            sums += squared_errors(outputs, batch).sum(1)
+            num_samples += len(batch['pop_gt'])
+
+    term_means = sums / max(num_samples, 1)
+    return weighted_loss(config, term_means).item(), term_means[3].sqrt().item()
+
+def evaluate(config, model, data_loader, device):
+    return evaluate_sums(config, model, tqdm(data_loader, desc="Evaluating"), device)
 
-            rmse = torch.sqrt(loss).item()
-            test_rmse += rmse
+def test(config, model, test_loader, device):
+    return evaluate_sums(config, model, test_loader, device)
+
+def _init_grid_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+def run_grid(trial_fn, param_grid, num_workers=0):
+    """
+    Run trial_fn(params) for every combination of param_grid (a dict of name ->
+    values) in a forked process pool. Trials read whatever trial_fn's module
+    prepared before the call as fork-inherited, read-only state, and each worker
+    gets an equal share of the cores through torch.set_num_threads.
+    num_workers=0 uses one worker per core, num_workers=1 runs in-process.
+    """
+    names = list(param_grid)
+    trials = [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+    num_cpus = os.cpu_count() or 1
+    num_workers = min(num_workers or num_cpus, len(trials))
+    print(f"Running {len(trials)} trials on {num_workers} workers")
+
+    if num_workers <= 1:
+        return [trial_fn(params) for params in trials]
 
-    average_loss = test_loss / len(test_loader)
-    average_rmse = test_rmse / len(test_loader)
-    return average_loss, average_rmse
+    num_threads = max(1, num_cpus // num_workers)
+    with mp.get_context('fork').Pool(num_workers, initializer=_init_grid_worker, initargs=(num_threads,)) as pool:
+        return pool.map(trial_fn, trials, chunksize=1)
 
 
 class EarlyStopping:
@@ -131,3 +181,34 @@ class EarlyStopping:
                 print(f'EarlyStopping counter: {self.counter} out of {self.patience}')
             if self.counter >= self.patience:
                 self.early_stop = True
+
+
+class SuccessiveHalving:
+    """
+    Asynchronous successive halving across grid trials. Trials report their
+    validation loss at the shared milestones min_epochs * reduction_factor**k,
+    and a trial outside the best 1/reduction_factor of the losses recorded at
+    that milestone so far is pruned. Pass a multiprocessing Manager to share
+    the milestone records between trials running in worker processes.
+    """
+    def __init__(self, max_epochs, reduction_factor=3, min_epochs=2, manager=None, verbose=False):
+        self.reduction_factor = reduction_factor
+        self.verbose = verbose
+        self.milestones = []
+        milestone = max(min_epochs, 1)
+        while reduction_factor > 1 and milestone < max_epochs:
+            self.milestones.append(milestone)
+            milestone *= reduction_factor
+        self.rungs = manager.dict() if manager is not None else {}
+        self.lock = manager.Lock() if manager is not None else contextlib.nullcontext()
+
+    def __call__(self, epochs_run, val_loss):
+        if epochs_run not in self.milestones:
+            return False
+        with self.lock:
+            losses = self.rungs.get(epochs_run, []) + [val_loss]
+            self.rungs[epochs_run] = losses
+        cutoff = np.percentile(losses, 100 / self.reduction_factor)
+        if self.verbose:
+            print(f'SuccessiveHalving milestone {epochs_run}: loss {val_loss:.4f}, cutoff {cutoff:.4f} over {len(losses)} trials')
+        return val_loss > cutoff